@@ -0,0 +1,327 @@
+"""
+bench.py — load test against local Telegram and media stand-ins
+================================================================
+Starts a fake Bot API server and a media server (fixture files of a chosen
+size, served with a chosen delay — yt-dlp's generic extractor downloads them
+like any direct link), runs main.py under uvicorn pointed at both, then
+replays synthetic Telegram updates into /webhook and web requests into
+/api/download.
+
+Запуск:
+    python bench.py --updates 200 --rate 50 --web 50 --web-rate 10 --unique 20
+    python bench.py --executor process --workers 8 --size-kb 2048 --media-latency 0.5
+    python bench.py --local          # fake server acts as a local telegram-bot-api (file:// uploads)
+
+Reports ack latency of /webhook and /api/download, end-to-end job latency
+(update sent → video delivered), jobs/s, cache hit rate and server memory.
+Nothing here touches the real Telegram API or the internet.
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+import subprocess
+from typing import Optional, Dict, List
+
+import httpx
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import Response, StreamingResponse
+
+BOT_TOKEN      = "bench"
+ADMIN_PASSWORD = "bench"
+CHUNK          = 64 * 1024
+
+# ──────────────────────────────────────────────────────────────
+# STAND-INS (fake Bot API + media server, one app)
+# ──────────────────────────────────────────────────────────────
+class StandIns:
+    def __init__(self, tg_latency: float, media_latency: float, size_bytes: int):
+        self.tg_latency    = tg_latency
+        self.media_latency = media_latency
+        self.size_bytes    = size_bytes
+        self.delivered: Dict[int, float] = {}      # chat_id -> time the job finished for it
+        self.outcomes:  Dict[int, str]   = {}
+        self.calls:     Dict[str, int]   = {}
+        self.media_requests = 0
+        self.path_uploads   = 0          # local mode: sendVideo with a file:// path
+        self.missing_paths  = 0
+        self.app = self._build()
+
+    def _finish(self, chat_id: int, outcome: str):
+        if chat_id not in self.delivered:
+            self.delivered[chat_id] = time.perf_counter()
+            self.outcomes[chat_id]  = outcome
+
+    def _build(self) -> FastAPI:
+        app = FastAPI()
+
+        @app.post("/bot{token}/{method}")
+        async def bot_api(token: str, method: str, request: Request):
+            self.calls[method] = self.calls.get(method, 0) + 1
+            body = await request.body()
+            await asyncio.sleep(self.tg_latency)
+            if request.headers.get("content-type", "").startswith("application/json"):
+                payload = json.loads(body or b"{}")
+            else:       # multipart upload: only chat_id is needed
+                m = re.search(rb'name="chat_id"\r\n\r\n(-?\d+)', body)
+                payload = {"chat_id": int(m.group(1))} if m else {}
+            chat_id = int(payload.get("chat_id") or 0)
+            result: Dict = {"message_id": 1, "chat": {"id": chat_id}}
+            if method == "sendVideo":
+                video = str(payload.get("video", ""))
+                if video.startswith("file://"):
+                    self.path_uploads += 1
+                    if not os.path.exists(video[len("file://"):]):
+                        self.missing_paths += 1
+                        return {"ok": False, "error_code": 400, "description": "Bad Request: file not found"}
+                result["video"] = {"file_id": f"bench-{chat_id}"}
+                self._finish(chat_id, "video")
+            elif method == "sendMessage":
+                text = payload.get("text", "")
+                if text.startswith("❌"):
+                    self._finish(chat_id, "error")
+                elif text.startswith("🚫"):
+                    self._finish(chat_id, "rejected")
+            return {"ok": True, "result": result}
+
+        @app.get("/media/{name}")
+        async def media(name: str):
+            self.media_requests += 1
+            await asyncio.sleep(self.media_latency)
+            size = self.size_bytes
+
+            async def body():
+                left = size
+                while left > 0:
+                    n = min(CHUNK, left)
+                    left -= n
+                    yield b"\0" * n
+
+            return StreamingResponse(body(), media_type="video/mp4",
+                                     headers={"Content-Length": str(size)})
+
+        @app.head("/media/{name}")
+        async def media_head(name: str):
+            return Response(media_type="video/mp4", headers={"Content-Length": str(self.size_bytes)})
+
+        return app
+
+async def serve(app: FastAPI, port: int) -> uvicorn.Server:
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.05)
+    return server
+
+# ──────────────────────────────────────────────────────────────
+# SERVER UNDER TEST
+# ──────────────────────────────────────────────────────────────
+def start_app(args, port: int, stand_ins_port: int, workdir: str) -> subprocess.Popen:
+    repo = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ,
+               BOT_TOKEN=BOT_TOKEN,
+               ADMIN_PASSWORD=ADMIN_PASSWORD,
+               TG_API_BASE=f"http://127.0.0.1:{stand_ins_port}",
+               WEBHOOK_URL="",
+               WORKER_COUNT=str(args.workers),
+               YTDLP_EXECUTOR=args.executor,
+               DOMAIN_CONCURRENCY=str(args.workers),
+               TG_GLOBAL_RATE="100000",
+               TG_CHAT_RATE="100000",
+               RATE_BURST="1000000",
+               MAX_QUEUE_PER_USER="1000000",
+               GLOBAL_QUEUE_LIMIT="1000000",
+               TG_LOCAL="1" if args.local else "",
+               PYTHONPATH=repo + os.pathsep + os.environ.get("PYTHONPATH", ""))
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port),
+         "--log-level", "warning"],
+        cwd=workdir, env=env)
+
+async def wait_ready(client: httpx.AsyncClient, base: str, proc: subprocess.Popen):
+    for _ in range(200):
+        if proc.poll() is not None:
+            raise SystemExit(f"server exited with code {proc.returncode}")
+        try:
+            await client.post(f"{base}/api/admin/stats", json={"password": ADMIN_PASSWORD})
+            return
+        except httpx.TransportError:
+            await asyncio.sleep(0.1)
+    raise SystemExit("server did not start")
+
+def memory_kb(pid: int) -> Dict[str, int]:
+    """VmRSS / VmHWM of a process (Linux /proc), in KiB."""
+    out: Dict[str, int] = {}
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                name, _, value = line.partition(":")
+                if name in ("VmRSS", "VmHWM"):
+                    out[name] = int(value.split()[0])
+    except OSError:
+        pass
+    return out
+
+# ──────────────────────────────────────────────────────────────
+# LOAD
+# ──────────────────────────────────────────────────────────────
+def percentile(values: List[float], q: float) -> Optional[float]:
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
+
+def fmt_ms(values: List[float]) -> str:
+    if not values:
+        return "—"
+    return f"p50 {percentile(values, 50) * 1000:.1f} ms, p99 {percentile(values, 99) * 1000:.1f} ms (n={len(values)})"
+
+async def paced(count: int, rate: float, send):
+    """Call send(i) count times at rate per second without waiting for replies."""
+    tasks = []
+    start = time.perf_counter()
+    for i in range(count):
+        delay = start + i / rate - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(send(i)))
+    return await asyncio.gather(*tasks)
+
+async def run(args):
+    stand_ins = StandIns(args.tg_latency, args.media_latency, args.size_kb * 1024)
+    await serve(stand_ins.app, args.stand_ins_port)
+    media = f"http://127.0.0.1:{args.stand_ins_port}/media"
+    urls  = [f"{media}/clip{i}.mp4" for i in range(max(1, args.unique))]
+
+    base = f"http://127.0.0.1:{args.port}"
+    with tempfile.TemporaryDirectory(prefix="saveit-bench-") as workdir:
+        proc = start_app(args, args.port, args.stand_ins_port, workdir)
+        limits = httpx.Limits(max_connections=1000, max_keepalive_connections=200)
+        async with httpx.AsyncClient(timeout=60, limits=limits) as client:
+            try:
+                await wait_ready(client, base, proc)
+                await bench(args, client, base, urls, stand_ins, proc)
+            finally:
+                proc.terminate()
+                try:
+                    proc.wait(timeout=10)
+                except subprocess.TimeoutExpired:
+                    proc.kill()
+
+async def bench(args, client: httpx.AsyncClient, base: str, urls: List[str], stand_ins: StandIns,
+                proc: subprocess.Popen):
+    rng = random.Random(args.seed)
+    webhook_ack: List[float] = []
+    web_ack:     List[float] = []
+    sent_at:     Dict[int, float] = {}      # telegram chat_id -> update sent
+    web_done:    Dict[str, float] = {}      # web job_id -> latency
+    web_jobs:    Dict[str, float] = {}
+    web_sent = 0
+
+    async def send_update(i: int):
+        chat_id = 100000 + i
+        update = {"update_id": i + 1, "message": {
+            "message_id": i + 1, "from": {"id": chat_id}, "chat": {"id": chat_id},
+            "text": rng.choice(urls)}}
+        t0 = time.perf_counter()
+        sent_at[chat_id] = t0
+        r = await client.post(f"{base}/webhook", json=update)
+        webhook_ack.append(time.perf_counter() - t0)
+        r.raise_for_status()
+
+    async def send_web(i: int):
+        nonlocal web_sent
+        t0 = time.perf_counter()
+        r = await client.post(f"{base}/api/download", json={"url": rng.choice(urls)})
+        web_ack.append(time.perf_counter() - t0)
+        web_sent += 1
+        if r.status_code == 200:
+            web_jobs[r.json()["job_id"]] = t0
+
+    async def poll_web():
+        while web_sent < args.web or len(web_done) < len(web_jobs):
+            for job_id, t0 in list(web_jobs.items()):
+                if job_id in web_done:
+                    continue
+                r = await client.get(f"{base}/api/status/{job_id}")
+                if r.status_code == 200 and r.json()["status"] in ("done", "error", "toobig"):
+                    web_done[job_id] = time.perf_counter() - t0
+            await asyncio.sleep(0.1)
+
+    started = time.perf_counter()
+    poller = asyncio.create_task(poll_web()) if args.web else None
+    await asyncio.gather(
+        paced(args.updates, args.rate, send_update),
+        paced(args.web, args.web_rate, send_web),
+    )
+    print(f"Load sent in {time.perf_counter() - started:.1f}s, waiting for jobs...")
+
+    deadline = time.perf_counter() + args.timeout
+    while time.perf_counter() < deadline:
+        tg_left = len(sent_at) - len(stand_ins.delivered)
+        if tg_left <= 0 and (poller is None or poller.done()):
+            break
+        await asyncio.sleep(0.1)
+    if poller is not None and not poller.done():
+        poller.cancel()
+    finished = time.perf_counter()
+
+    tg_e2e = [stand_ins.delivered[c] - sent_at[c] for c in stand_ins.delivered if c in sent_at]
+    outcomes: Dict[str, int] = {}
+    for outcome in stand_ins.outcomes.values():
+        outcomes[outcome] = outcomes.get(outcome, 0) + 1
+    web_e2e = list(web_done.values())
+    done = len(tg_e2e) + len(web_e2e)
+    stats = (await client.post(f"{base}/api/admin/stats", json={"password": ADMIN_PASSWORD})).json()
+    mem = memory_kb(proc.pid)
+
+    served = stats.get("downloads_ok", 0) + stats.get("served_from_cache", 0)
+    print()
+    print(f"Webhook ack:        {fmt_ms(webhook_ack)}")
+    print(f"/api/download ack:  {fmt_ms(web_ack)}")
+    print(f"Telegram job e2e:   {fmt_ms(tg_e2e)}")
+    print(f"Web job e2e:        {fmt_ms(web_e2e)}")
+    print(f"Jobs finished:      {done} / {args.updates + args.web}  "
+          f"({done / max(finished - started, 1e-9):.2f} jobs/s)")
+    print(f"Cache hit rate:     {stats.get('served_from_cache', 0) / max(served, 1):.1%} "
+          f"(downloads {stats.get('downloads_ok', 0)}, cache {stats.get('served_from_cache', 0)}, "
+          f"coalesced {stats.get('coalesced', 0)}, errors {stats.get('errors', 0)})")
+    print(f"Telegram outcomes:  {outcomes}")
+    print(f"Media fetches:      {stand_ins.media_requests}")
+    if args.local:
+        print(f"file:// uploads:    {stand_ins.path_uploads} ({stand_ins.missing_paths} paths not found)")
+    print(f"Bot API calls:      {dict(sorted(stand_ins.calls.items()))}")
+    if mem:
+        print(f"Server memory:      RSS {mem.get('VmRSS', 0) / 1024:.1f} MiB, peak {mem.get('VmHWM', 0) / 1024:.1f} MiB")
+
+def main():
+    ap = argparse.ArgumentParser(description="SaveIt load test with local Telegram/media stand-ins")
+    ap.add_argument("--updates", type=int, default=200, help="Telegram updates to send")
+    ap.add_argument("--rate", type=float, default=50, help="Telegram updates per second")
+    ap.add_argument("--web", type=int, default=0, help="/api/download requests to send")
+    ap.add_argument("--web-rate", type=float, default=10, help="web requests per second")
+    ap.add_argument("--unique", type=int, default=20, help="distinct media URLs (fewer → more cache hits)")
+    ap.add_argument("--size-kb", type=int, default=512, help="fixture media size")
+    ap.add_argument("--media-latency", type=float, default=0.2, help="media server delay per request, s")
+    ap.add_argument("--tg-latency", type=float, default=0.02, help="fake Bot API delay per call, s")
+    ap.add_argument("--workers", type=int, default=4)
+    ap.add_argument("--local", action="store_true", help="local Bot API mode: uploads by file path")
+    ap.add_argument("--executor", choices=("thread", "process"), default="thread")
+    ap.add_argument("--timeout", type=float, default=300, help="max wait for jobs after the load, s")
+    ap.add_argument("--port", type=int, default=18000)
+    ap.add_argument("--stand-ins-port", type=int, default=18001)
+    ap.add_argument("--seed", type=int, default=1)
+    args = ap.parse_args()
+    if args.rate <= 0 or args.web_rate <= 0:
+        ap.error("rates must be positive")
+    asyncio.run(run(args))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,494 @@
+"""
+downloader.py — yt-dlp helpers + warm process pool
+===================================================
+Kept free of app state (no FastAPI, no SQLite) so that pool worker
+processes only import this module and yt-dlp. yt-dlp itself is imported
+lazily (load_ytdlp) so that importing this module is instant.
+"""
+
+import os
+import copy
+import glob
+import time
+import uuid
+import signal
+import asyncio
+import threading
+import multiprocessing
+from contextlib import contextmanager
+from typing import Optional, Dict, Any, Set, List, Tuple, Callable
+
+# ──────────────────────────────────────────────────────────────
+# YOUTUBEDL INSTANCES (lazy import, reused per option profile)
+# ──────────────────────────────────────────────────────────────
+_yt_dlp = None
+_import_lock = threading.Lock()
+import_seconds: Optional[float] = None       # how long `import yt_dlp` took
+
+def load_ytdlp():
+    """Import yt_dlp on first use; it loads hundreds of extractors and takes a while."""
+    global _yt_dlp, import_seconds
+    if _yt_dlp is None:
+        with _import_lock:
+            if _yt_dlp is None:
+                started = time.perf_counter()
+                import yt_dlp
+                import_seconds = time.perf_counter() - started
+                _yt_dlp = yt_dlp
+    return _yt_dlp
+
+class _Slot:
+    """One YoutubeDL plus the per-job progress callback its permanent hook calls."""
+
+    def __init__(self, ydl):
+        self.ydl  = ydl
+        self.hook: Optional[Callable[[Dict[str, Any]], None]] = None
+        self.uses = 0
+        ydl.add_progress_hook(self._dispatch)
+
+    def _dispatch(self, d: Dict[str, Any]):
+        if self.hook is not None:
+            self.hook(d)
+
+    def close(self):
+        try:
+            self.ydl.close()
+        except Exception:
+            pass
+
+class YdlPool:
+    """Idle YoutubeDL instances per option profile, borrowed by one job at a time.
+
+    Building a YoutubeDL sets up extractors, the cookie jar and the cache, so
+    instances are kept and reused. Per-job settings (format, size limit,
+    progress callback, output name via the dl_id info field) are applied to
+    the borrowed instance. An instance that raised is closed, not reused, and
+    each one is retired after MAX_USES jobs.
+    """
+
+    MAX_USES = 100
+    MAX_IDLE = 8              # per profile
+
+    def __init__(self):
+        self._idle: Dict[tuple, List[_Slot]] = {}
+        self._lock = threading.Lock()
+        self.created       = 0
+        self.reused        = 0
+        self.setup_seconds = 0.0        # total spent constructing instances
+
+    @staticmethod
+    def _options(profile: tuple) -> Dict[str, Any]:
+        opts = {"quiet": True, "no_warnings": True, "noplaylist": True}
+        if profile[0] == "probe":
+            opts["skip_download"] = True
+        else:                            # ("download", out_dir)
+            opts.update({
+                "outtmpl": os.path.join(profile[1], "%(dl_id)s.%(ext)s"),
+                "format": DEFAULT_FORMAT,
+                "merge_output_format": "mp4",
+                "overwrites": True,
+                "continuedl": False,
+                "nopart": True,
+            })
+        return opts
+
+    def _create(self, profile: tuple) -> _Slot:
+        yt_dlp  = load_ytdlp()
+        started = time.perf_counter()
+        slot = _Slot(yt_dlp.YoutubeDL(self._options(profile)))
+        with self._lock:
+            self.created       += 1
+            self.setup_seconds += time.perf_counter() - started
+        return slot
+
+    @contextmanager
+    def borrow(self, profile: tuple):
+        with self._lock:
+            idle = self._idle.get(profile)
+            slot = idle.pop() if idle else None
+            if slot is not None:
+                self.reused += 1
+        if slot is None:
+            slot = self._create(profile)
+        try:
+            yield slot
+        except BaseException:
+            slot.close()
+            raise
+        slot.hook = None
+        slot.uses += 1
+        with self._lock:
+            idle = self._idle.setdefault(profile, [])
+            if slot.uses < self.MAX_USES and len(idle) < self.MAX_IDLE:
+                idle.append(slot)
+                return
+        slot.close()
+
+    def warm(self, out_dir: str):
+        """Import yt-dlp and pre-build one instance per profile (call off the event loop)."""
+        for profile in (("probe",), ("download", out_dir)):
+            with self.borrow(profile):
+                pass
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "import_s":   round(import_seconds, 3) if import_seconds is not None else None,
+                "created":    self.created,
+                "reused":     self.reused,
+                "setup_ms":   round(self.setup_seconds / self.created * 1000, 1) if self.created else None,
+                "idle":       sum(len(v) for v in self._idle.values()),
+            }
+
+ydl_pool = YdlPool()
+
+# ──────────────────────────────────────────────────────────────
+# YT-DLP HELPERS
+# ──────────────────────────────────────────────────────────────
+def safe_cleanup(prefix: str):
+    for p in glob.glob(prefix + ".*"):
+        try:
+            os.remove(p)
+        except Exception:
+            pass
+
+def ytdlp_probe(url: str) -> Dict[str, Any]:
+    with ydl_pool.borrow(("probe",)) as slot:
+        return slot.ydl.sanitize_info(slot.ydl.extract_info(url, download=False))
+
+def estimate_size_bytes(info: Dict) -> Optional[int]:
+    for k in ("filesize", "filesize_approx"):
+        v = info.get(k)
+        if isinstance(v, int) and v > 0:
+            return v
+    best = None
+    for f in (info.get("formats") or []):
+        if f.get("filesize"):
+            if f.get("ext") == "mp4":
+                return f["filesize"]
+            if best is None:
+                best = f
+    if best:
+        return best.get("filesize")
+    return None
+
+DEFAULT_FORMAT = "mp4/best"
+
+def format_size(f: Dict[str, Any], duration: Optional[float]) -> Optional[int]:
+    """Known or approximate size of one format in bytes."""
+    for k in ("filesize", "filesize_approx"):
+        v = f.get(k)
+        if isinstance(v, (int, float)) and v > 0:
+            return int(v)
+    tbr = f.get("tbr")
+    if tbr and duration:
+        return int(tbr * 1000 / 8 * duration)
+    return None
+
+def _fits(f: Dict[str, Any], size: int, max_bytes: int) -> bool:
+    # Approximations get 10% headroom; the streaming guard catches the rest
+    return size <= (max_bytes if f.get("filesize") else max_bytes * 0.9)
+
+def pick_format(info: Dict[str, Any], max_bytes: int) -> Tuple[Optional[str], Optional[int]]:
+    """Choose the best quality format that fits under max_bytes.
+
+    Returns (format_spec, estimated_size). A progressive MP4 that fits always
+    wins (no ffmpeg merge, plays inline in Telegram); next come H.264 MP4 video
+    + m4a audio merges, then other progressive formats, and other pairs only
+    when nothing else fits. Within a tier the higher resolution wins.
+    format_spec is None only when sizes are known and nothing fits
+    (estimated_size is then the smallest one).
+    """
+    formats  = [f for f in (info.get("formats") or [])
+                if f.get("format_id") and f.get("ext") != "mhtml" and f.get("protocol") != "mhtml"]
+    duration = info.get("duration")
+    if not formats:
+        size = estimate_size_bytes(info)
+        if size and size > max_bytes:
+            return None, size
+        return DEFAULT_FORMAT, size
+
+    def has(f, kind):
+        return f.get(kind) not in ("none",)
+
+    # (tier, height, tbr, spec, size) — tier 3: progressive mp4, 2: avc1 mp4 + m4a,
+    # 1: other progressive, 0: other merges
+    candidates: List[tuple] = []
+    smallest: Optional[int] = None
+    unknown = False
+    audio = sorted(
+        ((f, format_size(f, duration)) for f in formats if has(f, "acodec") and not has(f, "vcodec")),
+        key=lambda x: (x[0].get("ext") == "m4a", x[0].get("abr") or x[0].get("tbr") or 0), reverse=True,
+    )
+    for f in formats:
+        if not has(f, "vcodec"):
+            continue
+        size = format_size(f, duration)
+        if size is None:
+            unknown = True
+            continue
+        height = f.get("height") or 0
+        tbr    = f.get("tbr") or 0
+        if has(f, "acodec"):
+            smallest = size if smallest is None else min(smallest, size)
+            if _fits(f, size, max_bytes):
+                tier = 3 if f.get("ext") == "mp4" else 1
+                candidates.append((tier, height, tbr, f["format_id"], size))
+            continue
+        # Video-only: pair with the best audio that still fits (m4a first)
+        avc = f.get("ext") == "mp4" and (f.get("vcodec") or "").startswith(("avc1", "avc3", "h264"))
+        for a, asize in audio:
+            if asize is None:
+                continue
+            total = size + asize
+            smallest = total if smallest is None else min(smallest, total)
+            if _fits(f, total, max_bytes) and _fits(a, total, max_bytes):
+                if f.get("ext") != "mp4" or a.get("ext") in ("m4a", "mp4"):
+                    tier = 2 if avc and a.get("ext") == "m4a" else 0
+                    candidates.append((tier, height, tbr, f"{f['format_id']}+{a['format_id']}", total))
+                    break
+
+    if candidates:
+        best = max(candidates, key=lambda c: (c[0], c[1], c[2]))
+        return best[3], best[4]
+    if unknown or smallest is None:
+        # Sizes not advertised — let yt-dlp filter and the streaming guard enforce the limit
+        return f"best[ext=mp4][filesize<?{max_bytes}]/best[filesize<?{max_bytes}]/{DEFAULT_FORMAT}", None
+    return None, smallest
+
+class FileTooBig(Exception):
+    """Download aborted because it exceeds the size limit."""
+
+    def __init__(self, size: int):
+        super().__init__(f"file is larger than the limit ({size / 1024 / 1024:.1f} MB)")
+        self.size = size
+
+def ytdlp_download(url: str, out_dir: str, info: Optional[Dict[str, Any]] = None,
+                   max_bytes: Optional[int] = None, format_spec: Optional[str] = None,
+                   progress: Optional[Callable[[int, Optional[int]], None]] = None) -> str:
+    """Download url into out_dir. With a probed info dict the page is not extracted again.
+
+    Bytes are watched as they arrive: the download is aborted with FileTooBig as
+    soon as max_bytes is exceeded (or announced by the server), and progress
+    (downloaded, expected_total) is reported at most twice a second.
+    """
+    job_id = f"dl_{int(time.time())}_{uuid.uuid4().hex[:8]}"
+
+    per_file: Dict[str, int] = {}      # video + audio parts are downloaded separately
+    aborted:  Dict[str, int] = {}
+    last_report = [0.0]
+
+    def hook(d: Dict[str, Any]):
+        name = d.get("filename") or ""
+        per_file[name] = d.get("downloaded_bytes") or d.get("total_bytes") or 0
+        downloaded = sum(per_file.values())
+        exact      = d.get("total_bytes")
+        expected   = downloaded - per_file[name] + (exact or d.get("total_bytes_estimate") or 0)
+        if max_bytes and (downloaded > max_bytes or (exact and downloaded - per_file[name] + exact > max_bytes)):
+            aborted["size"] = max(downloaded, expected)
+            raise FileTooBig(aborted["size"])
+        now = time.monotonic()
+        if progress and (d.get("status") == "finished" or now - last_report[0] >= 0.5):
+            last_report[0] = now
+            progress(downloaded, int(expected) if expected else None)
+
+    spec = format_spec or DEFAULT_FORMAT
+    try:
+        with ydl_pool.borrow(("download", out_dir)) as slot:
+            ydl = slot.ydl
+            slot.hook = hook
+            # No max_filesize: yt-dlp would skip an over-limit file silently; the
+            # hook raises FileTooBig on the first callback that announces the size
+            ydl.params["format"] = spec
+            ydl.format_selector  = ydl.build_format_selector(spec)
+            if info is None:
+                info = ydl.sanitize_info(ydl.extract_info(url, download=False))
+            # Format selection + download on the (probed) metadata; the output name
+            # comes from the dl_id field, the outtmpl of the instance is fixed
+            ie_result = copy.deepcopy(info)
+            ie_result["dl_id"] = job_id
+            result = ydl.process_ie_result(ie_result, download=True)
+            downloads = result.get("requested_downloads") or [{}]
+            filename  = downloads[0].get("filepath") or ydl.prepare_filename(result)
+    except Exception:
+        safe_cleanup(os.path.join(out_dir, job_id))   # partial / fragment files
+        if aborted:
+            raise FileTooBig(aborted["size"]) from None
+        raise
+    if not os.path.exists(filename):
+        raise RuntimeError("yt-dlp finished without producing a file")
+    return filename
+
+# ──────────────────────────────────────────────────────────────
+# PROCESS POOL
+# ──────────────────────────────────────────────────────────────
+class WorkerError(Exception):
+    """An exception raised inside a pool process, carried back as plain data."""
+
+    def __init__(self, kind: str, message: str):
+        super().__init__(message)
+        self.kind = kind
+
+def _plain_attrs(e: Exception) -> Dict[str, Any]:
+    return {k: v for k, v in vars(e).items() if isinstance(v, (int, float, str, bool, type(None)))}
+
+def _worker_main(conn, out_dir: str):
+    """Pool process: run (fn, args) requests one at a time, reply with plain data."""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)    # shutdown is driven by the parent
+    ydl_pool.warm(out_dir)                           # import yt-dlp before taking calls
+    conn.send("ready")
+
+    def send_progress(done: int, total: Optional[int]):
+        conn.send(("progress", done, total))
+
+    while True:
+        try:
+            fn, args, want_progress = conn.recv()
+        except (EOFError, OSError):
+            return
+        try:
+            result = fn(*args, progress=send_progress) if want_progress else fn(*args)
+            conn.send(("ok", result))
+        except Exception as e:
+            conn.send(("error", type(e).__name__, str(e)[:1000], _plain_attrs(e)))
+
+class _Worker:
+    def __init__(self, proc, conn):
+        self.proc = proc
+        self.conn = conn
+
+    def kill(self):
+        try:
+            self.proc.kill()
+        except Exception:
+            pass
+        self.conn.close()
+
+class YtdlpProcessPool:
+    """Bounded pool of warm processes for yt-dlp calls.
+
+    A call that times out or is cancelled kills its process (yt-dlp cannot be
+    interrupted from outside) and a fresh one is spawned in the background.
+    Processes use the "spawn" start method so no locks are inherited from the
+    threaded parent. Pipes are watched with loop.add_reader, so a running call
+    does not hold a thread of the default executor.
+    """
+
+    def __init__(self, size: int, out_dir: str):
+        self.size     = size
+        self.out_dir  = out_dir          # download profile warmed in each process
+        self.spawned  = 0
+        self.killed   = 0
+        self._ctx     = multiprocessing.get_context("spawn")
+        self._idle:    Optional[asyncio.Queue] = None
+        self._workers: Set[_Worker] = set()
+        self._tasks:   Set[asyncio.Task] = set()
+
+    @staticmethod
+    async def _recv(conn):
+        """conn.recv() once a message (or EOF) is waiting on the pipe."""
+        loop = asyncio.get_running_loop()
+        while not conn.poll():
+            readable = loop.create_future()
+            loop.add_reader(conn.fileno(), lambda: readable.done() or readable.set_result(None))
+            try:
+                await readable
+            finally:
+                loop.remove_reader(conn.fileno())
+        return conn.recv()
+
+    async def _spawn(self) -> _Worker:
+        """Start a process and wait until it has imported yt-dlp."""
+        parent, child = self._ctx.Pipe()
+        proc = self._ctx.Process(target=_worker_main, args=(child, self.out_dir), daemon=True)
+        proc.start()
+        child.close()
+        w = _Worker(proc, parent)
+        try:
+            if await self._recv(parent) != "ready":
+                raise RuntimeError("yt-dlp worker failed to start")
+        except BaseException:
+            w.kill()
+            raise
+        return w
+
+    async def _add_worker(self):
+        delay = 1
+        while True:
+            try:
+                w = await self._spawn()
+                break
+            except Exception as e:
+                print(f"yt-dlp worker spawn failed: {e}")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 60)
+        self.spawned += 1
+        self._workers.add(w)
+        self._idle.put_nowait(w)
+
+    def _background(self, coro):
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def start(self):
+        """Spawn the processes in the background; calls wait until one is warm."""
+        self._idle = asyncio.Queue()
+        for _ in range(self.size):
+            self._background(self._add_worker())
+
+    def _retire(self, w: _Worker):
+        self._workers.discard(w)
+        w.kill()
+        self.killed += 1
+        self._background(self._add_worker())
+
+    async def run(self, fn: Callable, *args, timeout: Optional[float] = None,
+                  progress: Optional[Callable[[int, Optional[int]], None]] = None):
+        """Call fn(*args) in a pool process; progress, if given, is called on the loop."""
+        w = await self._idle.get()
+        healthy = False
+
+        async def exchange():
+            while True:
+                msg = await self._recv(w.conn)
+                if msg[0] != "progress":
+                    return msg
+                if progress:
+                    progress(msg[1], msg[2])
+
+        try:
+            w.conn.send((fn, args, progress is not None))
+            reply = await asyncio.wait_for(exchange(), timeout)
+            healthy = True
+        except asyncio.TimeoutError:
+            raise WorkerError("Timeout", f"yt-dlp call exceeded {timeout:g}s") from None
+        except (EOFError, OSError) as e:
+            raise WorkerError("WorkerCrashed", f"yt-dlp worker died: {e}") from None
+        finally:
+            if healthy:
+                self._idle.put_nowait(w)
+            else:
+                self._retire(w)
+        if reply[0] == "ok":
+            return reply[1]
+        _, kind, message, attrs = reply
+        if kind == "FileTooBig":
+            raise FileTooBig(attrs.get("size", 0))
+        raise WorkerError(kind, message)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "size":    self.size,
+            "alive":   len(self._workers),
+            "idle":    self._idle.qsize() if self._idle else 0,
+            "spawned": self.spawned,
+            "killed":  self.killed,
+        }
+
+    async def close(self):
+        for t in list(self._tasks):
+            t.cancel()
+        for w in list(self._workers):
+            w.kill()
+        self._workers.clear()
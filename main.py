@@ -10,24 +10,42 @@ main.py — FastAPI + Telegram Webhook + Web Interface
 
 import os
 import re
+import sys
+import gzip
 import json
+import math
 import time
 import uuid
-import glob
 import hmac
 import hashlib
+import socket
+import sqlite3
 import asyncio
-from dataclasses import dataclass, field
-from typing import Optional, Dict, Any, Set, List
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from bisect import bisect_left
+from contextlib import contextmanager
+from collections import deque, OrderedDict
+from dataclasses import dataclass, field, asdict
+from typing import Optional, Dict, Any, Set, List, Deque, Tuple, Callable
 from pathlib import Path
+from urllib.parse import urlparse, urlunparse, parse_qs, parse_qsl, urlencode
 
-import yt_dlp
 import httpx
 from fastapi import FastAPI, HTTPException, Request, Header
-from fastapi.responses import FileResponse, HTMLResponse
+from fastapi.responses import FileResponse, HTMLResponse, StreamingResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 
+try:
+    import brotli                     # optional: pip install brotli
+except ImportError:
+    brotli = None
+
+from downloader import (
+    ytdlp_probe, ytdlp_download, pick_format, safe_cleanup, YtdlpProcessPool, FileTooBig, ydl_pool,
+)
+
 # ──────────────────────────────────────────────────────────────
 # CONFIG
 # ──────────────────────────────────────────────────────────────
@@ -43,26 +61,106 @@ ADMIN_IDS: Set[int] = set(
     if x.strip().isdigit()
 )
 
-MAX_MB           = 50
+# Свой telegram-bot-api сервер в режиме --local (TG_API_BASE=http://127.0.0.1:8081 TG_LOCAL=1):
+# видео передаётся путём к файлу (file://), а не байтами, и лимит поднимается до 2000 МБ
+TG_LOCAL         = os.getenv("TG_LOCAL", "").strip().lower() in ("1", "true", "yes")
+MAX_MB           = int(os.getenv("MAX_MB", "2000" if TG_LOCAL else "50"))
 MAX_BYTES        = MAX_MB * 1024 * 1024
 COOLDOWN_SECONDS = 12
-MAX_QUEUE_PER_USER = 2
-GLOBAL_QUEUE_LIMIT = 100
-
-TG_API = f"https://api.telegram.org/bot{BOT_TOKEN}"
+# Лимит запросов: token bucket на пользователя/IP — RATE_BURST запросов подряд,
+# дальше один на COOLDOWN_SECONDS. RATE_MAX_KEYS — потолок числа bucket'ов в памяти
+RATE_BURST       = max(1, int(os.getenv("RATE_BURST", "1")))
+RATE_MAX_KEYS    = max(1, int(os.getenv("RATE_MAX_KEYS", "100000")))
+MAX_QUEUE_PER_USER = int(os.getenv("MAX_QUEUE_PER_USER", "2"))
+GLOBAL_QUEUE_LIMIT = int(os.getenv("GLOBAL_QUEUE_LIMIT", "100"))
+
+WORKER_COUNT       = max(1, int(os.getenv("WORKER_COUNT", "4")))
+DOMAIN_CONCURRENCY = max(1, int(os.getenv("DOMAIN_CONCURRENCY", "2")))   # по умолчанию на домен
+# Переопределения по доменам: "youtube.com:3,tiktok.com:2"
+DOMAIN_LIMITS: Dict[str, int] = {
+    k.strip().lower(): max(1, int(v))
+    for k, _, v in (x.partition(":") for x in os.getenv("DOMAIN_LIMITS", "").split(","))
+    if k.strip() and v.strip().isdigit()
+}
+
+# Веса источников в планировщике: "telegram:2,web:1" (по умолчанию поровну)
+SOURCE_WEIGHTS: Dict[str, int] = {"telegram": 1, "web": 1}
+SOURCE_WEIGHTS.update({
+    k.strip().lower(): max(1, int(v))
+    for k, _, v in (x.partition(":") for x in os.getenv("SOURCE_WEIGHTS", "").split(","))
+    if k.strip() and v.strip().isdigit()
+})
+DEFAULT_JOB_SECONDS = 20      # ETA guess until real job durations are known
+
+# Негативный кэш: повторные запросы заведомо неудачных ссылок отвечаются сразу
+NEGATIVE_CACHE_SIZE  = 4096
+NEGATIVE_TTL_TOOBIG  = int(os.getenv("NEGATIVE_TTL_TOOBIG", "21600"))   # размер видео не меняется
+NEGATIVE_TTL_ERROR   = int(os.getenv("NEGATIVE_TTL_ERROR", "900"))      # удалено / приватное / не поддерживается
+# Circuit breaker по домену: при доле ошибок >= BREAKER_ERROR_RATE среди последних
+# BREAKER_WINDOW задач домен «открывается» на BREAKER_OPEN_SECONDS, затем одна пробная задача
+BREAKER_WINDOW       = 20
+BREAKER_MIN_CALLS    = 8
+BREAKER_ERROR_RATE   = float(os.getenv("BREAKER_ERROR_RATE", "0.6"))
+BREAKER_OPEN_SECONDS = int(os.getenv("BREAKER_OPEN_SECONDS", "120"))
+
+TG_API_BASE = os.getenv("TG_API_BASE", "https://api.telegram.org").rstrip("/")   # свой Bot API сервер / bench.py
+TG_API      = f"{TG_API_BASE}/bot{BOT_TOKEN}"
+# Путь к downloads/ так, как его видит Bot API сервер (если он в другом контейнере)
+TG_LOCAL_DIR = os.getenv("TG_LOCAL_DIR", "").rstrip("/")
+
+# Outbound Bot API limits (Telegram: ~1 msg/s per chat, ~30 msg/s overall)
+TG_GLOBAL_RATE  = float(os.getenv("TG_GLOBAL_RATE", "25"))
+TG_CHAT_RATE    = float(os.getenv("TG_CHAT_RATE", "1"))
+TG_CHAT_BURST   = int(os.getenv("TG_CHAT_BURST", "3"))
+TG_SENDERS      = int(os.getenv("TG_SENDERS", "4"))
+TG_MAX_ATTEMPTS = 5
+# Video uploads may take Telegram minutes to answer: the read/write timeout is a minute
+# plus a second per MB, capped so a stalled upload frees its sender slot eventually
+TG_UPLOAD_TIMEOUT = float(os.getenv("TG_UPLOAD_TIMEOUT", "600"))
+
+UPDATE_DEDUP_SIZE  = 4096      # recent update_ids remembered for redelivery dedup
+UPDATE_QUEUE_LIMIT = 10000
+
+SSE_KEEPALIVE_SECONDS = 15
+SSE_RETRY_MS          = 3000
+
+# Метрики: /metrics в формате Prometheus (METRICS_TOKEN — Bearer-токен, если задан)
+METRICS_TOKEN      = os.getenv("METRICS_TOKEN", "")
+METRIC_BUCKETS     = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300, 600)
+METRIC_MAX_DOMAINS = 200       # дальше домены идут под меткой "other"
+SLOW_JOB_SECONDS   = float(os.getenv("SLOW_JOB_SECONDS", "0"))   # 0 — не логировать
 
 CACHE_FILE     = "cache.json"
+FILE_IDS_FILE  = "file_ids.json"
 BANS_FILE      = "bans.json"
 STATS_FILE     = "stats.json"
 HISTORY_FILE   = "history.json"
 USERS_FILE     = "users.json"
+DB_FILE        = os.getenv("DB_FILE", "state.db")
+STATE_FLUSH_SECONDS = float(os.getenv("STATE_FLUSH_SECONDS", "2"))
 DOWNLOADS_DIR  = Path("downloads")
 DOWNLOADS_DIR.mkdir(exist_ok=True)
+# Кэш по умолчанию вмещает хотя бы 10 видео максимального размера
+CACHE_MAX_BYTES      = int(os.getenv("CACHE_MAX_MB", str(max(2048, 10 * MAX_MB)))) * 1024 * 1024
+ORPHAN_GRACE_SECONDS = 3600     # files younger than this may still be downloading
+
+# yt-dlp executor: "thread" (default thread pool) or "process" (warm process pool,
+# keeps extractor CPU work off the event loop's GIL)
+YTDLP_EXECUTOR  = os.getenv("YTDLP_EXECUTOR", "thread").strip().lower()
+YTDLP_PROCESSES = max(1, int(os.getenv("YTDLP_PROCESSES", str(WORKER_COUNT))))
+YTDLP_TIMEOUT   = float(os.getenv("YTDLP_TIMEOUT", "900"))
+
+# Горизонтальное масштабирование: общий backend для очереди, статусов задач,
+# кулдаунов и индекса кэша ("memory" или "sqlite:///path/on/shared/disk").
+# ROLE: all — API и воркеры, api — только приём запросов, worker — только загрузки
+BACKEND_URL     = os.getenv("BACKEND_URL", "memory").strip()
+BACKEND_JOURNAL = os.getenv("BACKEND_JOURNAL", "wal")
+ROLE            = os.getenv("ROLE", "all").strip().lower()
 
 URL_RE = re.compile(r"(https?://\S+)", re.IGNORECASE)
 
 # ──────────────────────────────────────────────────────────────
-# STORAGE HELPERS
+# STORAGE (SQLite, WAL)
 # ──────────────────────────────────────────────────────────────
 def load_json(path: str, default):
     try:
@@ -71,44 +169,339 @@ def load_json(path: str, default):
     except Exception:
         return default
 
-def save_json(path: str, data):
-    tmp = path + ".tmp"
-    with open(tmp, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
-    os.replace(tmp, path)
-
-# In-memory state
-url_cache: Dict[str, str]  = load_json(CACHE_FILE, {})   # url -> filepath
-banned_ids: Set[int]        = set(load_json(BANS_FILE, []))
-stats: Dict[str, Any]       = load_json(STATS_FILE, {
+class StateStore:
+    """Persistent state: counters, history, users, bans, url/file_id caches.
+
+    Writes are buffered in memory and committed in a single transaction by
+    flush(), which runs in a thread every STATE_FLUSH_SECONDS, so the event
+    loop never touches the disk for bookkeeping.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS meta      (name TEXT PRIMARY KEY, value TEXT);
+        CREATE TABLE IF NOT EXISTS counters  (name TEXT PRIMARY KEY, value INTEGER NOT NULL DEFAULT 0);
+        CREATE TABLE IF NOT EXISTS history   (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                                              url TEXT, status TEXT, size_mb REAL, ts INTEGER, source TEXT);
+        CREATE TABLE IF NOT EXISTS users     (id INTEGER PRIMARY KEY);
+        CREATE TABLE IF NOT EXISTS bans      (id INTEGER PRIMARY KEY);
+        CREATE TABLE IF NOT EXISTS url_cache (key TEXT PRIMARY KEY, path TEXT NOT NULL, size INTEGER NOT NULL DEFAULT 0,
+                                              last_access INTEGER NOT NULL DEFAULT 0, hits INTEGER NOT NULL DEFAULT 0);
+        CREATE TABLE IF NOT EXISTS file_ids  (key TEXT PRIMARY KEY, file_id TEXT NOT NULL);
+    """
+
+    # Created after _add_columns, since they cover upgraded columns
+    INDEXES = """
+        CREATE INDEX IF NOT EXISTS history_ts     ON history (ts);
+        CREATE INDEX IF NOT EXISTS history_status ON history (status, id);
+        CREATE INDEX IF NOT EXISTS history_source ON history (source, id);
+        CREATE INDEX IF NOT EXISTS history_domain ON history (domain, id);
+    """
+
+    def __init__(self, path: str):
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(self.SCHEMA)
+        self._add_columns("url_cache", {
+            "size":        "INTEGER NOT NULL DEFAULT 0",
+            "last_access": "INTEGER NOT NULL DEFAULT 0",
+            "hits":        "INTEGER NOT NULL DEFAULT 0",
+        })
+        self._add_columns("history", {"domain": "TEXT NOT NULL DEFAULT ''"})
+        self.db.executescript(self.INDEXES)
+        self._db_lock    = threading.Lock()
+        self._flush_lock = asyncio.Lock()
+        self._pending: List[tuple] = []      # (sql, params) waiting for the next flush
+        self._deltas:  Dict[str, int] = {}   # counter increments waiting for the next flush
+        self._import_json()
+
+    def _add_columns(self, table: str, columns: Dict[str, str]):
+        """Schema upgrade for databases created by older versions."""
+        have = {row[1] for row in self.db.execute(f"PRAGMA table_info({table})")}
+        for name, decl in columns.items():
+            if name not in have:
+                self.db.execute(f"ALTER TABLE {table} ADD COLUMN {name} {decl}")
+
+    def _import_json(self):
+        """One-time import of the legacy *.json state files."""
+        if self.db.execute("SELECT 1 FROM meta WHERE name = 'json_imported'").fetchone():
+            return
+        with self._db_lock:
+            self.db.execute("BEGIN")
+            for name, value in load_json(STATS_FILE, {}).items():
+                if isinstance(value, int):
+                    self.db.execute("INSERT OR REPLACE INTO counters VALUES (?, ?)", (name, value))
+            for h in reversed(load_json(HISTORY_FILE, [])):
+                self.db.execute("INSERT INTO history (url, status, size_mb, ts, source) VALUES (?, ?, ?, ?, ?)",
+                                (h.get("url", ""), h.get("status", ""), h.get("size_mb", 0), h.get("ts", 0), h.get("source", "web")))
+            for x in load_json(USERS_FILE, []):
+                if str(x).lstrip("-").isdigit():
+                    self.db.execute("INSERT OR IGNORE INTO users VALUES (?)", (int(x),))
+            for x in load_json(BANS_FILE, []):
+                if str(x).lstrip("-").isdigit():
+                    self.db.execute("INSERT OR IGNORE INTO bans VALUES (?)", (int(x),))
+            for key, path in load_json(CACHE_FILE, {}).items():
+                self.db.execute("INSERT OR REPLACE INTO url_cache (key, path) VALUES (?, ?)", (key, path))
+            for key, fid in load_json(FILE_IDS_FILE, {}).items():
+                self.db.execute("INSERT OR REPLACE INTO file_ids VALUES (?, ?)", (key, fid))
+            self.db.execute("INSERT INTO meta VALUES ('json_imported', ?)", (str(int(time.time())),))
+            self.db.execute("COMMIT")
+
+    # --- reads (startup) ---
+    def rows(self, sql: str, params: tuple = ()):
+        """Iterate rows lazily — nothing is materialised beyond what the caller keeps."""
+        return self.db.execute(sql, params)
+
+    def scalar(self, sql: str, params: tuple = ()):
+        with self._db_lock:
+            return self.db.execute(sql, params).fetchone()[0]
+
+    def query(self, sql: str, params: tuple = ()) -> List[tuple]:
+        """Read rows under the lock (call from a thread, not the event loop)."""
+        with self._db_lock:
+            return self.db.execute(sql, params).fetchall()
+
+    # --- buffered writes ---
+    def write(self, sql: str, params: tuple = ()):
+        self._pending.append((sql, params))
+
+    def counter(self, name: str, n: int = 1):
+        self._deltas[name] = self._deltas.get(name, 0) + n
+
+    def _commit(self, ops: List[tuple], deltas: Dict[str, int]):
+        with self._db_lock:
+            self.db.execute("BEGIN")
+            try:
+                for name, n in deltas.items():
+                    self.db.execute(
+                        "INSERT INTO counters VALUES (?, ?) "
+                        "ON CONFLICT(name) DO UPDATE SET value = value + excluded.value", (name, n))
+                for sql, params in ops:
+                    self.db.execute(sql, params)
+                self.db.execute("COMMIT")
+            except Exception:
+                self.db.execute("ROLLBACK")
+                raise
+
+    async def flush(self):
+        async with self._flush_lock:
+            ops, self._pending = self._pending, []
+            deltas, self._deltas = self._deltas, {}
+            if not (ops or deltas):
+                return
+            try:
+                await asyncio.to_thread(self._commit, ops, deltas)
+            except Exception:
+                # Rolled back: put the batch back ahead of writes buffered meanwhile
+                self._pending[:0] = ops
+                for name, n in deltas.items():
+                    self._deltas[name] = self._deltas.get(name, 0) + n
+                raise
+
+    def close(self):
+        with self._db_lock:
+            self.db.close()
+
+store = StateStore(DB_FILE)
+
+# In-memory state (loaded row by row from the store)
+# url_key -> filepath, least recently used first; cache_meta holds size/last_access/hits
+url_cache: "OrderedDict[str, str]" = OrderedDict()
+cache_meta: Dict[str, Dict[str, int]] = {}
+for _k, _p, _size, _la, _hits in store.rows("SELECT key, path, size, last_access, hits FROM url_cache ORDER BY last_access"):
+    url_cache[_k]  = _p
+    cache_meta[_k] = {"size": _size, "last_access": _la, "hits": _hits}
+banned_ids: Set[int] = {i for (i,) in store.rows("SELECT id FROM bans")}
+stats: Dict[str, Any] = {
     "total_requests": 0,
     "served_from_cache": 0,
     "downloads_ok": 0,
     "blocked_big": 0,
     "errors": 0,
-})
-
-_raw_users = load_json(USERS_FILE, [])
-users: Set[int] = {int(x) for x in _raw_users if str(x).lstrip("-").isdigit()}
-
-# History: list of dicts {url, status, size_mb, ts, source}
-history: List[Dict] = load_json(HISTORY_FILE, [])
-HISTORY_LIMIT = 200
-
-def save_users():
-    save_json(USERS_FILE, sorted(list(users)))
+    "coalesced": 0,
+}
+stats.update({name: value for name, value in store.rows("SELECT name, value FROM counters")})
+
+# Telegram file_ids: url_key -> file_id, least recently used first. Memory keeps the
+# most recent ones, the file_ids table has all of them (REPLACE moves a row to the end)
+FILE_ID_CACHE_SIZE = 10000
+file_id_cache: "OrderedDict[str, str]" = OrderedDict(reversed(list(store.rows(
+    "SELECT key, file_id FROM file_ids ORDER BY rowid DESC LIMIT ?", (FILE_ID_CACHE_SIZE,)))))
+
+# Users: the total is counted in the DB, memory keeps only recently seen ids
+RECENT_USERS_SIZE = 10000
+recent_users: "OrderedDict[int, None]" = OrderedDict()
+user_count = store.scalar("SELECT COUNT(*) FROM users")
+users_dirty = False
+
+# History: an indexed table written through the buffered store (ids assigned by SQLite,
+# so every process sharing state.db can append), pruned by the hourly cleanup
+HISTORY_KEEP           = int(os.getenv("HISTORY_KEEP", "1000000"))        # rows kept on disk
+HISTORY_RETENTION_DAYS = float(os.getenv("HISTORY_RETENTION_DAYS", "90"))
+HISTORY_FIELDS = ("id", "url", "status", "size_mb", "ts", "source", "domain")
+
+def bump(name: str, n: int = 1):
+    stats[name] = stats.get(name, 0) + n
+    store.counter(name, n)
+
+def save_user(user_id: int):
+    global users_dirty
+    if user_id in recent_users:
+        recent_users.move_to_end(user_id)
+        return
+    recent_users[user_id] = None
+    if len(recent_users) > RECENT_USERS_SIZE:
+        recent_users.popitem(last=False)
+    store.write("INSERT OR IGNORE INTO users VALUES (?)", (user_id,))
+    users_dirty = True
+
+async def refresh_user_count():
+    """Recount users after new ids were flushed (the DB knows which were new)."""
+    global user_count, users_dirty
+    if users_dirty:
+        users_dirty = False
+        user_count = await asyncio.to_thread(store.scalar, "SELECT COUNT(*) FROM users")
+
+def set_banned(user_id: int, banned: bool):
+    if banned:
+        banned_ids.add(user_id)
+        store.write("INSERT OR IGNORE INTO bans VALUES (?)", (user_id,))
+    else:
+        banned_ids.discard(user_id)
+        store.write("DELETE FROM bans WHERE id = ?", (user_id,))
+
+def _cache_file_id(key: str, file_id: str):
+    file_id_cache[key] = file_id
+    file_id_cache.move_to_end(key)
+    while len(file_id_cache) > FILE_ID_CACHE_SIZE:
+        file_id_cache.popitem(last=False)
+
+async def file_id_get(key: str) -> Optional[str]:
+    """file_id for key: from memory, else from the file_ids table."""
+    file_id = file_id_cache.get(key)
+    if file_id is not None:
+        file_id_cache.move_to_end(key)
+        return file_id
+    rows = await asyncio.to_thread(store.query, "SELECT file_id FROM file_ids WHERE key = ?", (key,))
+    if not rows:
+        return None
+    _cache_file_id(key, rows[0][0])
+    return rows[0][0]
+
+def remember_file_id(key: str, file_id: str):
+    _cache_file_id(key, file_id)
+    store.write("INSERT OR REPLACE INTO file_ids VALUES (?, ?)", (key, file_id))
+
+def forget_file_id(key: str):
+    file_id_cache.pop(key, None)
+    store.write("DELETE FROM file_ids WHERE key = ?", (key,))
+
+def add_history(url: str, status: str, size_mb: float = 0, source: str = "web", domain: str = ""):
+    store.write("INSERT INTO history (url, status, size_mb, ts, source, domain) VALUES (?, ?, ?, ?, ?, ?)",
+                (url[:120], status, round(size_mb, 1), int(time.time()), source, domain))
+
+def prune_history():
+    store.write("DELETE FROM history WHERE ts < ?", (int(time.time() - HISTORY_RETENTION_DAYS * 86400),))
+    store.write("DELETE FROM history WHERE id <= (SELECT MAX(id) FROM history) - ?", (HISTORY_KEEP,))
+
+def query_history(filters: Dict[str, Any], cursor: Optional[int], limit: int,
+                  with_counts: bool) -> Dict[str, Any]:
+    """One page of history (newest first, ids below cursor) plus counts for the same filters."""
+    where, params = [], []
+    for col in ("status", "source", "domain"):
+        if filters.get(col):
+            where.append(f"{col} = ?")
+            params.append(filters[col])
+    if filters.get("since"):
+        where.append("ts >= ?")
+        params.append(filters["since"])
+    if filters.get("until"):
+        where.append("ts < ?")
+        params.append(filters["until"])
+    match = " AND ".join(where) or "1"
+    page  = match + (" AND id < ?" if cursor else "")
+    rows  = store.query(f"SELECT {', '.join(HISTORY_FIELDS)} FROM history WHERE {page} ORDER BY id DESC LIMIT ?",
+                        tuple(params) + ((cursor,) if cursor else ()) + (limit,))
+    items = [dict(zip(HISTORY_FIELDS, row)) for row in rows]
+    result: Dict[str, Any] = {
+        "history":     items,
+        "next_cursor": items[-1]["id"] if len(items) == limit else None,
+    }
+    if with_counts:
+        result["counts"] = {
+            col: dict(store.query(f"SELECT {col}, COUNT(*) FROM history WHERE {match} "
+                                  f"GROUP BY {col} ORDER BY COUNT(*) DESC LIMIT 50", tuple(params)))
+            for col in ("status", "source", "domain")
+        }
+        result["total"] = sum(result["counts"]["status"].values())
+    return result
 
-def add_history(url: str, status: str, size_mb: float = 0, source: str = "web"):
-    history.insert(0, {
-        "url": url[:120],
-        "status": status,
-        "size_mb": round(size_mb, 1),
-        "ts": int(time.time()),
-        "source": source,
-    })
-    if len(history) > HISTORY_LIMIT:
-        history[:] = history[:HISTORY_LIMIT]
-    save_json(HISTORY_FILE, history)
+# ──────────────────────────────────────────────────────────────
+# METRICS (Prometheus text format)
+# ──────────────────────────────────────────────────────────────
+def _label_value(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+class Histogram:
+    """Latency histogram per label set, rendered as Prometheus cumulative buckets."""
+
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...], buckets=METRIC_BUCKETS):
+        self.name      = name
+        self.help_text = help_text
+        self.labels    = labels
+        self.buckets   = tuple(buckets)
+        self._series: Dict[Tuple[str, ...], List[float]] = {}   # labels -> per-bucket counts (+Inf last), sum
+
+    def observe(self, value: float, *labels: str):
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [0] * (len(self.buckets) + 2)
+        series[bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for labels, series in sorted(self._series.items()):
+            base = ",".join(f'{k}="{_label_value(v)}"' for k, v in zip(self.labels, labels))
+            sep  = "," if base else ""
+            total = 0
+            for bound, n in zip(self.buckets + ("+Inf",), series):
+                total += n
+                lines.append(f'{self.name}_bucket{{{base}{sep}le="{bound}"}} {total}')
+            lines.append(f"{self.name}_sum{{{base}}} {series[-1]:.6f}")
+            lines.append(f"{self.name}_count{{{base}}} {total}")
+        return lines
+
+stage_seconds = Histogram("saveit_stage_seconds", "Time spent in each job stage",
+                          ("stage", "domain", "source"))
+job_seconds   = Histogram("saveit_job_seconds", "Time from request to delivery",
+                          ("domain", "source", "outcome"))
+tg_api_seconds = Histogram("saveit_telegram_api_seconds", "Bot API request latency",
+                           ("method", "outcome"))
+metric_domains: Set[str] = set()
+
+def metric_domain(url: str) -> str:
+    """Extractor domain as a label value; bounded so junk URLs can't explode the series."""
+    domain = extractor_domain(url)
+    if domain in metric_domains:
+        return domain
+    if len(metric_domains) >= METRIC_MAX_DOMAINS:
+        return "other"
+    metric_domains.add(domain)
+    return domain
+
+def observe_stage(job, stage: str, seconds: float):
+    job.spans[stage] = round(job.spans.get(stage, 0) + seconds, 3)
+    stage_seconds.observe(seconds, stage, metric_domain(job.url), job.source)
+
+@contextmanager
+def job_span(job, stage: str):
+    """Time a block of work as one stage of the job."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(job, stage, time.perf_counter() - started)
 
 # ──────────────────────────────────────────────────────────────
 # YT-DLP HELPERS
@@ -119,54 +512,365 @@ def extract_url(text: str) -> Optional[str]:
         return None
     return re.sub(r"[)\]}>,.]+$", "", m.group(1))
 
+# ── URL canonicalisation (cache / single-flight key) ──
+TRACKING_PARAMS = {
+    "igshid", "igsh", "si", "fbclid", "gclid", "yclid", "feature", "ref", "ref_src", "ref_url",
+    "share", "share_id", "_r", "_t", "is_from_webapp", "sender_device", "sender_web_id",
+    "web_id", "mibextid",
+}
+SHORT_LINK_HOSTS = {"vm.tiktok.com", "vt.tiktok.com", "pin.it", "t.co", "fb.watch"}
+
+YT_ID = r"([A-Za-z0-9_-]{11})"
+# (host suffix, path regex, key prefix) — first match wins, group 1 is the video id
+CANONICAL_PATTERNS = [
+    ("youtube.com",   re.compile(r"^/(?:shorts|embed|live|v)/" + YT_ID), "youtube"),
+    ("youtu.be",      re.compile(r"^/" + YT_ID), "youtube"),
+    ("instagram.com", re.compile(r"^/(?:[\w.]+/)?(?:p|reel|reels|tv)/([\w-]+)"), "instagram"),
+    ("tiktok.com",    re.compile(r"^/(?:@[\w.-]+/)?(?:video|photo)/(\d+)"), "tiktok"),
+    ("tiktok.com",    re.compile(r"^/v/(\d+)"), "tiktok"),
+    ("twitter.com",   re.compile(r"^/\w+/status/(\d+)"), "twitter"),
+    ("x.com",         re.compile(r"^/\w+/status/(\d+)"), "twitter"),
+    ("reddit.com",    re.compile(r"^/r/\w+/comments/(\w+)"), "reddit"),
+    ("vk.com",        re.compile(r"^/(?:video|clip)(-?\d+_\d+)"), "vk"),
+]
+
+def _normalise_host(host: str) -> str:
+    host = host.lower().rstrip(".")
+    for prefix in ("www.", "m.", "mobile.", "mbasic.", "music."):
+        if host.startswith(prefix):
+            host = host[len(prefix):]
+    if host == "youtube-nocookie.com":
+        host = "youtube.com"
+    if re.match(r"^(?:[a-z]{2}\.)?pinterest\.[a-z.]+$", host):
+        host = "pinterest.com"
+    return host
+
 def url_key(url: str) -> str:
-    return url.strip()
+    """Canonical cache key: "<extractor>:<id>" for known sites, cleaned URL otherwise."""
+    url = url.strip()
+    try:
+        p = urlparse(url)
+    except ValueError:
+        return url
+    host = _normalise_host(p.hostname or "")
+    path = re.sub(r"/{2,}", "/", p.path or "/")
+
+    if host == "youtube.com" and path.rstrip("/") == "/watch":
+        v = parse_qs(p.query).get("v", [""])[0]
+        if re.fullmatch(YT_ID, v):
+            return f"youtube:{v}"
+    if host == "pinterest.com":
+        m = re.match(r"^/pin/(?:[\w-]*--)?(\d+)", path)
+        if m:
+            return f"pinterest:{m.group(1)}"
+    for suffix, rx, prefix in CANONICAL_PATTERNS:
+        if host == suffix or host.endswith("." + suffix):
+            m = rx.match(path)
+            if m:
+                return f"{prefix}:{m.group(1)}"
+
+    query = sorted(
+        (k, v) for k, v in parse_qsl(p.query, keep_blank_values=True)
+        if k.lower() not in TRACKING_PARAMS and not k.lower().startswith("utm_")
+    )
+    return urlunparse(("https", host, path.rstrip("/") or "/", "", urlencode(query), ""))
+
+# Memoised short-link resolution: url -> (resolved_at, key)
+short_link_cache: "OrderedDict[str, tuple]" = OrderedDict()
+SHORT_LINK_CACHE_SIZE = 5000
+SHORT_LINK_TTL        = 86400
+
+def _is_short_link(url: str) -> bool:
+    p = urlparse(url.strip())
+    host = (p.hostname or "").lower()
+    return host in SHORT_LINK_HOSTS or (_normalise_host(host) == "tiktok.com" and p.path.startswith("/t/"))
+
+def cached_key(url: str) -> str:
+    """resolve_key() without the network: a memoised short-link target, else url_key()."""
+    if _is_short_link(url):
+        hit = short_link_cache.get(url.strip())
+        if hit and time.time() - hit[0] < SHORT_LINK_TTL:
+            return hit[1]
+    return url_key(url)
+
+async def resolve_key(url: str) -> str:
+    """url_key() that first follows short-link redirects (vm.tiktok.com, pin.it, ...)."""
+    if not _is_short_link(url):
+        return url_key(url)
+    url = url.strip()
+    hit = short_link_cache.get(url)
+    if hit and time.time() - hit[0] < SHORT_LINK_TTL:
+        short_link_cache.move_to_end(url)
+        return hit[1]
+    try:
+        async with get_http().stream("GET", url, follow_redirects=True, timeout=5) as r:
+            key = url_key(str(r.url))
+    except Exception:
+        return url_key(url)      # unresolved — not memoised, retry next time
+    short_link_cache[url] = (time.time(), key)
+    short_link_cache.move_to_end(url)
+    while len(short_link_cache) > SHORT_LINK_CACHE_SIZE:
+        short_link_cache.popitem(last=False)
+    return key
+
+# Short-link / mobile hosts that belong to the same extractor
+DOMAIN_ALIASES = {
+    "youtu.be":      "youtube.com",
+    "vm.tiktok.com": "tiktok.com",
+    "vt.tiktok.com": "tiktok.com",
+    "pin.it":        "pinterest.com",
+    "instagr.am":    "instagram.com",
+}
+
+def extractor_domain(url: str) -> str:
+    host = (urlparse(url.strip()).hostname or "").lower()
+    host = DOMAIN_ALIASES.get(host, host)
+    parts = host.split(".")
+    if len(parts) >= 3 and parts[-2] in ("co", "com", "org", "net"):
+        return ".".join(parts[-3:])          # pinterest.co.uk
+    return ".".join(parts[-2:]) if host else "unknown"
+
+def domain_limit(domain: str) -> int:
+    return DOMAIN_LIMITS.get(domain, DOMAIN_CONCURRENCY)
+
+ytdlp_pool: Optional[YtdlpProcessPool] = YtdlpProcessPool(YTDLP_PROCESSES, str(DOWNLOADS_DIR)) if YTDLP_EXECUTOR == "process" else None
+
+# Thread mode: yt-dlp gets its own threads, so long downloads never take the default
+# executor's threads from state flushes, backend queries and the like
+ytdlp_threads: Optional[ThreadPoolExecutor] = (
+    ThreadPoolExecutor(max_workers=WORKER_COUNT, thread_name_prefix="ytdlp") if ytdlp_pool is None else None
+)
 
-def safe_cleanup(prefix: str):
-    for p in glob.glob(prefix + ".*"):
+async def run_ytdlp(fn, *args, progress=None):
+    """Run a yt-dlp helper in the configured executor, bounded by YTDLP_TIMEOUT.
+
+    progress(done, total), if given, is always invoked on the event loop.
+    """
+    if ytdlp_pool is not None:
+        return await ytdlp_pool.run(fn, *args, timeout=YTDLP_TIMEOUT, progress=progress)
+    loop = asyncio.get_running_loop()
+    if progress is None:
+        call = lambda: fn(*args)
+    else:
+        threadsafe = lambda done, total: loop.call_soon_threadsafe(progress, done, total)
+        call = lambda: fn(*args, progress=threadsafe)
+    return await asyncio.wait_for(loop.run_in_executor(ytdlp_threads, call), YTDLP_TIMEOUT)
+
+# Short-TTL cache of probe results: url_key -> (probed_at, info)
+probe_cache: "OrderedDict[str, tuple]" = OrderedDict()
+# Info dicts run to hundreds of KB (every format of every stream), so keep few
+PROBE_CACHE_SIZE = 32
+PROBE_TTL        = 300      # media URLs in info dicts expire, keep this short
+
+def probe_cache_get(key: str) -> Optional[Dict[str, Any]]:
+    hit = probe_cache.get(key)
+    if not hit:
+        return None
+    if time.time() - hit[0] > PROBE_TTL:
+        probe_cache.pop(key, None)
+        return None
+    return hit[1]
+
+def probe_cache_expire(now: Optional[float] = None):
+    """Entries are in put order, so the expired ones are all at the front."""
+    now = time.time() if now is None else now
+    while probe_cache:
+        ts, _ = next(iter(probe_cache.values()))
+        if now - ts <= PROBE_TTL:
+            break
+        probe_cache.popitem(last=False)
+
+def probe_cache_put(key: str, info: Dict[str, Any]):
+    now = time.time()
+    probe_cache_expire(now)
+    probe_cache[key] = (now, info)
+    probe_cache.move_to_end(key)
+    while len(probe_cache) > PROBE_CACHE_SIZE:
+        probe_cache.popitem(last=False)
+
+# ──────────────────────────────────────────────────────────────
+# DOWNLOAD CACHE (downloads/, LRU within CACHE_MAX_BYTES)
+# ──────────────────────────────────────────────────────────────
+def cache_bytes() -> int:
+    return sum(m["size"] for m in cache_meta.values())
+
+def cache_get(key: str) -> Optional[str]:
+    """Path of a cached file (recording the access), or None."""
+    path = url_cache.get(key)
+    if path is None:
+        return None
+    if not os.path.exists(path):
+        cache_drop(key)
+        return None
+    now  = int(time.time())
+    meta = cache_meta.setdefault(key, {"size": 0, "last_access": now, "hits": 0})
+    meta["last_access"] = now
+    meta["hits"] += 1
+    url_cache.move_to_end(key)
+    store.write("UPDATE url_cache SET last_access = ?, hits = hits + 1 WHERE key = ?", (now, key))
+    return path
+
+def cache_put(key: str, path: str):
+    try:
+        size = os.path.getsize(path)
+    except OSError:
+        size = 0
+    now = int(time.time())
+    url_cache[key]  = path
+    cache_meta[key] = {"size": size, "last_access": now, "hits": 0}
+    url_cache.move_to_end(key)
+    store.write("INSERT OR REPLACE INTO url_cache (key, path, size, last_access, hits) VALUES (?, ?, ?, ?, 0)",
+                (key, path, size, now))
+    evict_cache()
+
+def cache_drop(key: str):
+    url_cache.pop(key, None)
+    cache_meta.pop(key, None)
+    store.write("DELETE FROM url_cache WHERE key = ?", (key,))
+
+def evict_cache():
+    """Delete least recently used files until the cache fits CACHE_MAX_BYTES."""
+    total = cache_bytes()
+    if total <= CACHE_MAX_BYTES:
+        return
+    # Files that a job still points at (web users may be about to fetch them)
+    in_use = {j.filename for j in job_store.values() if j.filename}
+    for key in list(url_cache):
+        if total <= CACHE_MAX_BYTES:
+            break
+        path = url_cache[key]
+        if path in in_use:
+            continue
+        total -= cache_meta.get(key, {}).get("size", 0)
+        cache_drop(key)
         try:
-            os.remove(p)
-        except Exception:
+            os.remove(path)
+        except OSError:
             pass
+        bump("cache_evictions")
 
-def ytdlp_probe(url: str) -> Dict[str, Any]:
-    with yt_dlp.YoutubeDL({"quiet": True, "no_warnings": True, "noplaylist": True, "skip_download": True}) as ydl:
-        return ydl.extract_info(url, download=False)
-
-def estimate_size_bytes(info: Dict) -> Optional[int]:
-    for k in ("filesize", "filesize_approx"):
-        v = info.get(k)
-        if isinstance(v, int) and v > 0:
-            return v
-    best = None
-    for f in (info.get("formats") or []):
-        if f.get("filesize"):
-            if f.get("ext") == "mp4":
-                return f["filesize"]
-            if best is None:
-                best = f
-    if best:
-        return best.get("filesize")
-    return None
+def _sweep_downloads(keep: Set[str], min_age: float) -> int:
+    """Remove files in downloads/ not in keep and older than min_age seconds."""
+    removed = 0
+    now = time.time()
+    for p in DOWNLOADS_DIR.iterdir():
+        try:
+            if str(p) in keep or not p.is_file() or now - p.stat().st_mtime < min_age:
+                continue
+            p.unlink()
+            removed += 1
+        except OSError:
+            pass
+    return removed
+
+async def reconcile_cache(min_age: float = 0):
+    """Drop index entries whose file is gone, delete orphaned files, enforce the budget."""
+    items   = await backend.cache_entries()
+    missing = await asyncio.to_thread(lambda: [k for k, p in items.items() if not os.path.exists(p)])
+    for key in missing:
+        await backend.cache_drop(key, items[key])     # unless replaced meanwhile
+    keep = set((await backend.cache_entries()).values()) | {j.filename for j in job_store.values() if j.filename}
+    removed = await asyncio.to_thread(_sweep_downloads, keep, min_age)
+    await backend.cache_evict()
+    if missing or removed:
+        print(f"Cache reconcile: {len(missing)} stale entries, {removed} orphaned files removed")
 
-def ytdlp_download(url: str) -> str:
-    job_id  = f"dl_{int(time.time())}_{uuid.uuid4().hex[:8]}"
-    outtmpl = str(DOWNLOADS_DIR / f"{job_id}.%(ext)s")
-    opts = {
-        "outtmpl": outtmpl,
-        "format": "mp4/best",
-        "merge_output_format": "mp4",
-        "noplaylist": True,
-        "quiet": True,
-        "no_warnings": True,
-        "overwrites": True,
-        "continuedl": False,
-        "nopart": True,
-    }
-    with yt_dlp.YoutubeDL(opts) as ydl:
-        info     = ydl.extract_info(url, download=True)
-        filename = ydl.prepare_filename(info)
-    return filename
+# ──────────────────────────────────────────────────────────────
+# FAILURE HANDLING (negative cache, per-domain circuit breaker)
+# ──────────────────────────────────────────────────────────────
+# yt-dlp errors that retrying the same URL won't fix
+PERMANENT_ERROR_RE = re.compile(
+    r"unsupported url|video unavailable|private video|has been removed|no longer available|"
+    r"does not exist|account.{0,20}(terminated|suspended)|http error 404|http error 410|"
+    r"not a valid url|no video formats found|this content isn.t available",
+    re.IGNORECASE)
+
+def is_permanent_error(msg: str) -> bool:
+    return bool(PERMANENT_ERROR_RE.search(msg or ""))
+
+# url_key -> (expires_at, status, size_mb, error_msg)
+negative_cache: "OrderedDict[str, tuple]" = OrderedDict()
+
+def negative_get(key: str) -> Optional[tuple]:
+    hit = negative_cache.get(key)
+    if not hit:
+        return None
+    if time.time() > hit[0]:
+        negative_cache.pop(key, None)
+        return None
+    return hit[1:]
+
+def negative_put(key: str, status: str, size_mb: float = 0, error_msg: str = ""):
+    ttl = NEGATIVE_TTL_TOOBIG if status == "toobig" else NEGATIVE_TTL_ERROR
+    negative_cache[key] = (time.time() + ttl, status, size_mb, error_msg)
+    negative_cache.move_to_end(key)
+    while len(negative_cache) > NEGATIVE_CACHE_SIZE:
+        negative_cache.popitem(last=False)
+
+class CircuitBreaker:
+    """Per-domain breaker over the outcomes of the last BREAKER_WINDOW jobs.
+
+    closed → open when the error rate gets too high; after BREAKER_OPEN_SECONDS
+    one trial job goes through (half-open) and its outcome closes or reopens it.
+    Only failures that point at the site count — dead links don't.
+    """
+
+    def __init__(self):
+        self._outcomes:   Dict[str, Deque[bool]] = {}     # domain -> recent ok flags
+        self._opened_at:  Dict[str, float] = {}
+        self._trial:      Set[str] = set()                # half-open domains with a trial running
+
+    def state(self, domain: str) -> str:
+        opened = self._opened_at.get(domain)
+        if opened is None:
+            return "closed"
+        return "open" if time.time() - opened < BREAKER_OPEN_SECONDS else "half_open"
+
+    def allow(self, domain: str) -> bool:
+        """May a job for this domain run now? Takes the trial slot when half-open."""
+        state = self.state(domain)
+        if state == "closed":
+            return True
+        if state == "half_open" and domain not in self._trial:
+            self._trial.add(domain)
+            return True
+        return False
+
+    def record(self, domain: str, ok: bool):
+        if domain in self._trial:
+            self._trial.discard(domain)
+            if ok:
+                self._opened_at.pop(domain, None)
+                self._outcomes.pop(domain, None)
+            else:
+                self._opened_at[domain] = time.time()
+            return
+        window = self._outcomes.setdefault(domain, deque(maxlen=BREAKER_WINDOW))
+        window.append(ok)
+        failures = window.count(False)
+        if len(window) >= BREAKER_MIN_CALLS and failures / len(window) >= BREAKER_ERROR_RATE:
+            self._opened_at[domain] = time.time()
+            window.clear()
+            print(f"Circuit breaker open for {domain} ({failures} failures)")
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        out = {}
+        for domain in set(self._outcomes) | set(self._opened_at):
+            window = self._outcomes.get(domain) or ()
+            out[domain] = {
+                "state":      self.state(domain),
+                "calls":      len(window),
+                "error_rate": round(list(window).count(False) / len(window), 2) if window else 0,
+            }
+            if domain in self._opened_at:
+                out[domain]["retry_in"] = max(0, int(self._opened_at[domain] + BREAKER_OPEN_SECONDS - time.time()))
+        return out
+
+breaker = CircuitBreaker()
+BREAKER_ERROR_MSG = "Сайт сейчас не отдаёт видео, попробуй позже"
+
+class BreakerOpen(Exception):
+    """The domain's breaker refused an extraction."""
 
 # ──────────────────────────────────────────────────────────────
 # QUEUE SYSTEM (unified for Telegram + Web)
@@ -182,148 +886,1147 @@ class Job:
     filename:  Optional[str] = None
     error_msg: str = ""
     size_mb:   float = 0.0
+    key:       str = ""               # canonical url_key, set on enqueue
+    domain:    str = ""               # extractor domain, set when queued
+    downloaded_bytes: int = 0         # live download progress
+    total_bytes:      int = 0         # expected size, 0 if unknown
     created_at: float = field(default_factory=time.time)
+    spans:      Dict[str, float] = field(default_factory=dict)   # stage -> seconds
+
+FINAL_STATUSES = ("done", "error", "toobig")
+
+class FairScheduler:
+    """Job queue that round-robins across user_keys and respects per-domain caps.
+
+    Sources ("telegram", "web") share the workers by weight using smooth
+    weighted round-robin, and inside a source every user with pending jobs
+    gets one job per turn — a burst from many web IPs can no longer push
+    Telegram users to the back. A user whose next job is for a saturated
+    domain is skipped (keeping its place) until a slot frees, so hot domains
+    never drain the queue out of order. position() replays the same selection
+    on a copy of the state, so reported positions match the dispatch order.
+    """
+
+    def __init__(self, weights: Dict[str, int], free_slots: Callable[[str], int],
+                 capacity: Callable[[str], int]):
+        self.weights    = weights
+        self.free_slots = free_slots     # domain -> slots free right now
+        self.capacity   = capacity       # domain -> concurrency limit
+        self._users:  Dict[str, Deque[str]] = {}    # source -> user_keys in turn order
+        self._jobs:   Dict[str, Deque[Job]] = {}    # user_key -> pending jobs
+        self._credit: Dict[str, float] = {}         # smooth WRR state per active source
+        self._size    = 0
+        self._changed = asyncio.Event()
+
+    def qsize(self) -> int:
+        return self._size
+
+    def put_nowait(self, job: Job):
+        if not job.domain:
+            job.domain = extractor_domain(job.url)
+        jobs = self._jobs.get(job.user_key)
+        if jobs is None:
+            jobs = self._jobs[job.user_key] = deque()
+            self._users.setdefault(job.source, deque()).append(job.user_key)
+        jobs.append(job)
+        self._size += 1
+        self._changed.set()
+
+    async def put(self, job: Job):
+        self.put_nowait(job)
+
+    def wake(self):
+        """A domain slot was freed: blocked get() calls look again."""
+        self._changed.set()
+
+    async def get(self) -> Job:
+        while True:
+            job = self._take()
+            if job is not None:
+                return job
+            self._changed.clear()
+            await self._changed.wait()
+
+    def task_done(self):
+        pass
+
+    def _take(self) -> Optional[Job]:
+        picked = self._select(self._users, self._credit, lambda uk: self._jobs[uk][0],
+                              lambda d: self.free_slots(d) > 0)
+        if picked is None:
+            return None
+        source, i = picked
+        users = self._users[source]
+        jobs  = self._jobs[users[i]]
+        job   = jobs.popleft()
+        self._advance(users, i, source, bool(jobs), self._users, self._credit)
+        if not jobs:
+            del self._jobs[job.user_key]
+        self._size -= 1
+        return job
+
+    def _select(self, users: Dict[str, Deque[str]], credit: Dict[str, float],
+                head: Callable[[str], Job], runnable: Callable[[str], bool]) -> Optional[Tuple[str, int]]:
+        """WRR over sources that have a runnable user; returns (source, index of its first runnable user)."""
+        ready: Dict[str, int] = {}
+        for source, uks in users.items():
+            for i, uk in enumerate(uks):
+                if runnable(head(uk).domain):
+                    ready[source] = i
+                    break
+        if not ready:
+            return None
+        source = self._pick_source(credit, ready)
+        return source, ready[source]
+
+    def _pick_source(self, credit: Dict[str, float], sources: Dict[str, Any]) -> str:
+        total = 0
+        for source in sources:
+            w = self.weights.get(source, 1)
+            credit[source] = credit.get(source, 0) + w
+            total += w
+        best = max(sources, key=lambda src: credit[src])
+        credit[best] -= total
+        return best
+
+    @staticmethod
+    def _advance(users: Deque[str], i: int, source: str, more: bool,
+                 all_users: Dict[str, Deque[str]], credit: Dict[str, float]):
+        uk = users[i]
+        del users[i]
+        if more:
+            users.append(uk)          # user goes to the back of its source's turn order
+        if not users:
+            del all_users[source]
+            credit.pop(source, None)
+
+    def position(self, job: Job) -> int:
+        """1-based dispatch position of a queued job, 0 if it is not queued here.
+
+        Saturated domains are modelled in rounds: once nothing runnable is
+        left, running jobs are assumed done and every domain is at full
+        capacity again.
+        """
+        jobs = self._jobs.get(job.user_key)
+        if not jobs or not any(j is job for j in jobs):
+            return 0
+        credit = dict(self._credit)
+        users  = {src: deque(u) for src, u in self._users.items()}
+        taken  = dict.fromkeys(self._jobs, 0)       # user_key -> jobs already dispatched
+        free: Dict[str, int] = {}
+        fresh = False                               # True once running jobs count as finished
+
+        def slots(domain: str) -> int:
+            if domain not in free:
+                free[domain] = self.capacity(domain) if fresh else self.free_slots(domain)
+            return free[domain]
+
+        head = lambda uk: self._jobs[uk][taken[uk]]
+        pos = 0
+        while True:
+            picked = self._select(users, credit, head, lambda d: slots(d) > 0)
+            if picked is None:
+                free.clear()
+                fresh = True
+                continue
+            pos += 1
+            source, i = picked
+            uk = users[source][i]
+            j  = head(uk)
+            if j is job:
+                return pos
+            free[j.domain] -= 1
+            taken[uk] += 1
+            self._advance(users[source], i, source, taken[uk] < len(self._jobs[uk]), users, credit)
+
+    def blocked(self) -> Dict[str, int]:
+        """Queued jobs per domain that has no free slot right now."""
+        out: Dict[str, int] = {}
+        for jobs in self._jobs.values():
+            for j in jobs:
+                if self.free_slots(j.domain) <= 0:
+                    out[j.domain] = out.get(j.domain, 0) + 1
+        return out
+
+class RateLimiter:
+    """Per-key token buckets with lazy expiry and a hard cap on the number of keys.
+
+    Buckets sit in an OrderedDict in last-use order. A bucket idle for
+    burst / rate seconds is full again, i.e. the same as no bucket, so expired
+    ones are dropped from the front on every hit. Past max_keys the least
+    recently used bucket goes, which at worst forgives one waiting key.
+    """
+
+    def __init__(self, rate: float, burst: int, max_keys: int):
+        self.rate     = rate
+        self.burst    = burst
+        self.max_keys = max_keys
+        self.ttl      = burst / rate
+        self._buckets: "OrderedDict[str, Tuple[float, float]]" = OrderedDict()   # key -> (tokens, updated)
+
+    def hit(self, key: str, now: Optional[float] = None) -> float:
+        """Take a token for key: 0 if allowed, else seconds until one is available."""
+        now = time.monotonic() if now is None else now
+        self.expire(now)
+        tokens, updated = self._buckets.pop(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        if tokens < 1:
+            self._buckets[key] = (tokens, now)
+            return (1 - tokens) / self.rate
+        self._buckets[key] = (tokens - 1, now)
+        if len(self._buckets) > self.max_keys:
+            self._buckets.popitem(last=False)
+        return 0
+
+    def expire(self, now: Optional[float] = None):
+        now = time.monotonic() if now is None else now
+        buckets = self._buckets
+        while buckets:
+            key, (_, updated) = next(iter(buckets.items()))
+            if now - updated < self.ttl:
+                break
+            del buckets[key]
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+    def footprint(self) -> int:
+        """Approximate bytes held: the dict plus one key, tuple and two floats per bucket."""
+        size = sys.getsizeof(self._buckets)
+        if self._buckets:
+            key, value = next(iter(self._buckets.items()))
+            size += len(self._buckets) * (sys.getsizeof(key) + sys.getsizeof(value) + 2 * sys.getsizeof(0.0))
+        return size
 
 job_store: Dict[str, Job] = {}
-queue: asyncio.Queue = asyncio.Queue()
-pending_per_key: Dict[str, int] = {}
-last_request_time: Dict[str, float] = {}
+queue = FairScheduler(SOURCE_WEIGHTS, lambda d: domain_limit(d) - domain_in_flight.get(d, 0), domain_limit)
+pending_per_key: Dict[str, int] = {}            # only keys with queued/processing jobs
+rate_limiter = RateLimiter(1 / COOLDOWN_SECONDS, RATE_BURST, RATE_MAX_KEYS)
 queue_lock = asyncio.Lock()
 
-async def enqueue(job: Job) -> bool:
-    async with queue_lock:
-        if queue.qsize() >= GLOBAL_QUEUE_LIMIT:
-            return False
-        if pending_per_key.get(job.user_key, 0) >= MAX_QUEUE_PER_USER:
-            return False
-        pending_per_key[job.user_key] = pending_per_key.get(job.user_key, 0) + 1
-        job_store[job.job_id] = job
-        await queue.put(job)
-        return True
+# Single-flight: url_key -> [leader, *followers] for jobs queued or processing
+in_flight: Dict[str, List[Job]] = {}
 
-async def finish(user_key: str):
-    async with queue_lock:
-        pending_per_key[user_key] = max(0, pending_per_key.get(user_key, 1) - 1)
+# Worker pool state
+busy_workers = 0
+domain_in_flight: Dict[str, int] = {}          # domain -> jobs being processed
 
-# ──────────────────────────────────────────────────────────────
-# TELEGRAM API HELPER
-# ──────────────────────────────────────────────────────────────
-async def tg_send(chat_id: int, text: str):
-    if not BOT_TOKEN:
-        return
-    async with httpx.AsyncClient() as client:
-        await client.post(f"{TG_API}/sendMessage", json={"chat_id": chat_id, "text": text})
+# Live status subscribers (SSE): job_id -> wake-up queues
+job_watchers: Dict[str, Set[asyncio.Queue]] = {}
 
-async def tg_send_video(chat_id: int, filepath: str) -> Optional[str]:
-    """Upload video, return file_id."""
-    if not BOT_TOKEN:
-        return None
-    async with httpx.AsyncClient(timeout=120) as client:
-        with open(filepath, "rb") as f:
-            r = await client.post(f"{TG_API}/sendVideo", data={"chat_id": str(chat_id)}, files={"video": f})
-        data = r.json()
-        if data.get("ok"):
-            return data["result"]["video"]["file_id"]
+async def job_snapshot(job: Job) -> Dict[str, Any]:
+    snap: Dict[str, Any] = {
+        "status":    job.status,
+        "error_msg": job.error_msg,
+        "size_mb":   round(job.size_mb, 1),
+        "ad_text":   AD_TEXT if job.status == "done" else "",
+    }
+    if job.status == "queued":
+        snap["position"] = await backend.position(job)
+        snap["eta_s"]    = queue_eta(snap["position"])
+    if job.status == "processing" and job.downloaded_bytes:
+        snap["downloaded_mb"] = round(job.downloaded_bytes / 1024 / 1024, 1)
+        snap["total_mb"]      = round(job.total_bytes / 1024 / 1024, 1) if job.total_bytes else None
+    if job.status == "done":
+        snap["download_url"] = f"/api/file/{job.job_id}"
+    if job.status == "toobig":
+        snap["max_mb"] = MAX_MB
+    return snap
+
+def notify_job(job: Job):
+    """Wake the job's status streams; they re-read the job themselves."""
+    backend.job_changed(job)
+    for wake in job_watchers.get(job.job_id, ()):
+        try:
+            wake.put_nowait(None)
+        except asyncio.QueueFull:
+            pass        # already has a pending wake-up
+
+# Recent job durations (seconds) for queue ETAs
+recent_durations: Deque[float] = deque(maxlen=50)
+
+def job_position(job: Job) -> int:
+    """Jobs to be started before this one finishes queueing (1 = next), 0 if not queued."""
+    if job.status != "queued":
+        return 0
+    lead = (in_flight.get(job.key) or [job])[0]
+    return queue.position(lead)
+
+def queue_eta(position: int) -> int:
+    """Seconds until a job at this position is done, from recent job durations."""
+    if position <= 0:
+        return 0
+    avg = sum(recent_durations) / len(recent_durations) if recent_durations else DEFAULT_JOB_SECONDS
+    return int(math.ceil(position / WORKER_COUNT) * avg + avg)
+
+def notify_queued():
+    """Positions moved: wake the status streams of queued jobs."""
+    for jid in list(job_watchers):
+        j = job_store.get(jid)
+        if j is not None and j.status == "queued":
+            notify_job(j)
+
+def queued_jobs() -> int:
+    return queue.qsize()
+
+async def sendable_file_id(job: Job, key: str) -> Optional[str]:
+    """file_id Telegram already has for key, if this job can be answered with it."""
+    if job.source == "telegram" and job.chat_id:
+        return await file_id_get(key)
     return None
 
+async def answer_early(job: Job) -> bool:
+    """Finish the job without queueing it: a known dead/too-big URL, or an open
+    breaker for a URL that is not cached (cached videos need no extraction)."""
+    hit = negative_get(job.key)
+    if hit:
+        job.status, job.size_mb, job.error_msg = hit
+        bump("negative_hits")
+        return True
+    if (breaker.state(extractor_domain(job.url)) == "open"
+            and not await sendable_file_id(job, job.key) and not await backend.cache_get(job.key)):
+        job.status, job.error_msg = "error", BREAKER_ERROR_MSG
+        bump("breaker_rejected")
+        return True
+    return False
+
 # ──────────────────────────────────────────────────────────────
-# WORKER
+# STATE BACKENDS (queue, job state, cooldowns, cache index)
 # ──────────────────────────────────────────────────────────────
-async def worker():
-    while True:
-        job: Job = await queue.get()
+class InMemoryBackend:
+    """Single-process backend: everything lives in this process's memory."""
+
+    shared = False
+
+    async def enqueue(self, job: Job) -> bool:
+        if not job.key:
+            job.key = cached_key(job.url)        # short links are resolved by the worker
+        if await answer_early(job):
+            job_store[job.job_id] = job
+            return True
+        async with queue_lock:
+            if queued_jobs() >= GLOBAL_QUEUE_LIMIT:
+                return False
+            if pending_per_key.get(job.user_key, 0) >= MAX_QUEUE_PER_USER:
+                return False
+            pending_per_key[job.user_key] = pending_per_key.get(job.user_key, 0) + 1
+            job_store[job.job_id] = job
+            key = job.key
+            flight = in_flight.get(key)
+            if flight:
+                # Same URL already queued/processing — finish from its result
+                job.status = flight[0].status
+                flight.append(job)
+                return True
+            in_flight[key] = [job]
+            await queue.put(job)
+            return True
+
+    async def dequeue(self) -> Job:
+        return await queue.get()
+
+    async def finish(self, job: Job):
+        async with queue_lock:
+            left = pending_per_key.get(job.user_key, 1) - 1
+            if left > 0:
+                pending_per_key[job.user_key] = left
+            else:
+                pending_per_key.pop(job.user_key, None)
+
+    def job_changed(self, job: Job):
+        pass        # the Job object itself is the state
+
+    async def get_job(self, job_id: str) -> Optional[Job]:
+        return job_store.get(job_id)
+
+    async def position(self, job: Job) -> int:
+        return job_position(job)
+
+    async def queued(self) -> int:
+        return queued_jobs()
+
+    async def rate_limit(self, key: str) -> float:
+        """Count a request for key; returns the wait in seconds if it is over the limit."""
+        return rate_limiter.hit(key)
+
+    async def limiter_stats(self) -> Dict[str, int]:
+        return {"keys": len(rate_limiter), "approx_bytes": rate_limiter.footprint(),
+                "pending_keys": len(pending_per_key)}
+
+    async def expire(self, max_age: float):
+        rate_limiter.expire()
+        now = time.time()
+        for jid, job in list(job_store.items()):
+            if now - job.created_at > max_age:
+                job_store.pop(jid, None)
+
+    async def cache_get(self, key: str) -> Optional[str]:
+        return cache_get(key)
+
+    async def cache_put(self, key: str, path: str):
+        cache_put(key, path)
+
+    async def cache_drop(self, key: str, path: Optional[str] = None):
+        if path is None or url_cache.get(key) == path:
+            cache_drop(key)
+
+    async def cache_entries(self) -> Dict[str, str]:
+        return dict(url_cache)
+
+    async def cache_evict(self):
+        evict_cache()
+
+    async def cache_stats(self):
+        return len(url_cache), cache_bytes()
+
+    async def close(self):
+        pass
+
+class SqliteBackend:
+    """Backend shared by several processes or nodes through one SQLite file.
+
+    Every API and worker process points at the same file
+    (BACKEND_URL=sqlite:////shared/saveit.db). Claims run under BEGIN
+    IMMEDIATE, so each job is taken by exactly one worker. Jobs with the same
+    url_key are claimed together, and a key another process is downloading is
+    not claimed until it finishes; its jobs are then served from the shared
+    cache index (single-flight across processes). Queue order
+    is round-robin over user_keys, weighted by SOURCE_WEIGHTS. Use
+    BACKEND_JOURNAL=delete on network filesystems, where WAL is unsupported.
+    """
+
+    shared = True
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS jobs (
+            seq        INTEGER PRIMARY KEY AUTOINCREMENT,
+            job_id     TEXT UNIQUE NOT NULL,
+            user_key   TEXT NOT NULL,
+            source     TEXT NOT NULL,
+            key        TEXT NOT NULL,
+            domain     TEXT NOT NULL DEFAULT '',
+            weight     INTEGER NOT NULL DEFAULT 1,
+            status     TEXT NOT NULL,
+            owner      TEXT,
+            data       TEXT NOT NULL,
+            updated_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, user_key, seq);
+        CREATE INDEX IF NOT EXISTS jobs_key    ON jobs (key, status);
+        CREATE TABLE IF NOT EXISTS rate_limits (key TEXT PRIMARY KEY, tokens REAL NOT NULL, ts REAL NOT NULL);
+        CREATE TABLE IF NOT EXISTS cache_index (key TEXT PRIMARY KEY, path TEXT NOT NULL, size INTEGER NOT NULL DEFAULT 0,
+                                                last_access INTEGER NOT NULL DEFAULT 0, hits INTEGER NOT NULL DEFAULT 0);
+    """
+
+    # Queued jobs with their round-robin turn: a user's n-th job gets turn n / weight
+    FAIR_ORDER = """
+        SELECT job_id, key, domain, seq,
+               ROW_NUMBER() OVER (PARTITION BY user_key ORDER BY seq) * 1.0 / weight AS turn
+        FROM jobs WHERE status = 'queued'
+    """
+
+    def __init__(self, path: str, journal: str = "wal"):
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self.db.execute(f"PRAGMA journal_mode={journal}")
+        self.db.executescript(self.SCHEMA)
+        if "domain" not in {row[1] for row in self.db.execute("PRAGMA table_info(jobs)")}:
+            self.db.execute("ALTER TABLE jobs ADD COLUMN domain TEXT NOT NULL DEFAULT ''")
+        self._lock  = threading.Lock()
+        self._dirty: Dict[str, Job] = {}
+        self._flush_task: Optional[asyncio.Task] = None
+        self._claim_lock = asyncio.Lock()    # one local claim at a time, so domain caps see every claim
+
+    # --- plumbing ---
+    async def _run(self, fn, *args):
+        def call():
+            with self._lock:
+                return fn(*args)
+        return await asyncio.to_thread(call)
+
+    def _tx(self, fn, *args):
+        self.db.execute("BEGIN IMMEDIATE")
         try:
-            job.status = "processing"
-            key = url_key(job.url)
-
-            # Cache hit
-            if key in url_cache and os.path.exists(url_cache[key]):
-                job.status   = "done"
-                job.filename  = url_cache[key]
-                stats["served_from_cache"] = stats.get("served_from_cache", 0) + 1
-                save_json(STATS_FILE, stats)
-                if job.source == "telegram" and job.chat_id:
-                    await tg_send_video(job.chat_id, job.filename)
-                    if AD_TEXT:
-                        await tg_send(job.chat_id, AD_TEXT)
-                    await tg_send(job.chat_id, "✅ Готово (из кэша)!")
-                add_history(job.url, "cache", job.size_mb, job.source)
+            result = fn(*args)
+            self.db.execute("COMMIT")
+            return result
+        except Exception:
+            self.db.execute("ROLLBACK")
+            raise
+
+    @staticmethod
+    def _dump(job: Job) -> str:
+        return json.dumps(asdict(job), ensure_ascii=False)
+
+    @staticmethod
+    def _load(status: str, data: str) -> Job:
+        fields = json.loads(data)
+        known  = {k: v for k, v in fields.items() if k in Job.__dataclass_fields__}
+        job = Job(**known)
+        job.status = status
+        return job
+
+    # --- queue ---
+    async def enqueue(self, job: Job) -> bool:
+        if not job.key:
+            job.key = cached_key(job.url)        # short links are resolved by the worker
+        job.domain = job.domain or extractor_domain(job.url)
+        early = await answer_early(job)
+
+        def insert() -> bool:
+            if early:
+                self.db.execute(
+                    "INSERT INTO jobs (job_id, user_key, source, key, status, data, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (job.job_id, job.user_key, job.source, job.key, job.status, self._dump(job), time.time()))
+                return True
+            (queued,) = self.db.execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued'").fetchone()
+            if queued >= GLOBAL_QUEUE_LIMIT:
+                return False
+            (mine,) = self.db.execute(
+                "SELECT COUNT(*) FROM jobs WHERE user_key = ? AND status IN ('queued', 'processing')",
+                (job.user_key,)).fetchone()
+            if mine >= MAX_QUEUE_PER_USER:
+                return False
+            self.db.execute(
+                "INSERT INTO jobs (job_id, user_key, source, key, domain, weight, status, data, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, 'queued', ?, ?)",
+                (job.job_id, job.user_key, job.source, job.key, job.domain, SOURCE_WEIGHTS.get(job.source, 1),
+                 self._dump(job), time.time()))
+            return True
+
+        return await self._run(self._tx, insert)
+
+    def _claim(self, saturated: List[str]) -> List[Job]:
+        """Take the next job whose domain has a free slot in this process.
+
+        Keys processing here are claimed anyway (dequeue attaches them to the
+        local flight); keys processing elsewhere wait for that download.
+        """
+        mine  = f"{self.owner}:"
+        where = "key NOT IN (SELECT key FROM jobs WHERE status = 'processing' AND substr(owner, 1, ?) != ?)"
+        if saturated:
+            where += f" AND domain NOT IN ({', '.join('?' * len(saturated))})"
+        row = self.db.execute(f"SELECT job_id, key FROM ({self.FAIR_ORDER}) WHERE {where} ORDER BY turn, seq LIMIT 1",
+                              (len(mine), mine, *saturated)).fetchone()
+        if not row:
+            return []
+        leader_id, key = row
+        token = f"{self.owner}:{uuid.uuid4().hex[:8]}"
+        self.db.execute("UPDATE jobs SET status = 'processing', owner = ?, updated_at = ? WHERE key = ? AND status = 'queued'",
+                        (token, time.time(), key))
+        rows = self.db.execute("SELECT job_id, data FROM jobs WHERE owner = ? ORDER BY job_id != ?, seq",
+                               (token, leader_id)).fetchall()
+        return [self._load("processing", data) for _, data in rows]
+
+    async def dequeue(self) -> Job:
+        delay = 0.1
+        while True:
+            # The worker counts the job in domain_in_flight right after we
+            # return, before the lock's next waiter gets to run
+            async with self._claim_lock:
+                saturated = [d for d, n in domain_in_flight.items() if n >= domain_limit(d)]
+                jobs = await self._run(self._tx, self._claim, saturated)
+            if not jobs:
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 1.0)
                 continue
-            elif key in url_cache:
-                url_cache.pop(key, None)
-                save_json(CACHE_FILE, url_cache)
-
-            if job.source == "telegram" and job.chat_id:
-                await tg_send(job.chat_id, "⏳ Начинаю обработку...")
-
-            # Probe size
-            try:
-                info = await asyncio.to_thread(ytdlp_probe, job.url)
-                size = estimate_size_bytes(info)
-                if size and size > MAX_BYTES:
-                    stats["blocked_big"] = stats.get("blocked_big", 0) + 1
-                    save_json(STATS_FILE, stats)
-                    job.status  = "toobig"
-                    job.size_mb = size / 1024 / 1024
-                    if job.source == "telegram" and job.chat_id:
-                        await tg_send(job.chat_id, f"🚫 Слишком большое видео (~{job.size_mb:.1f} МБ). Лимит {MAX_MB} МБ.")
-                    add_history(job.url, "toobig", job.size_mb, job.source)
+            delay = 0.1
+            for j in jobs:
+                job_store[j.job_id] = j
+            flight = in_flight.get(jobs[0].key)
+            if flight:
+                flight.extend(jobs)          # already downloading here — attach
+                continue
+            in_flight[jobs[0].key] = jobs
+            return jobs[0]
+
+    async def finish(self, job: Job):
+        pass        # per-user limits are derived from job status
+
+    # --- job state ---
+    def job_changed(self, job: Job):
+        """Queue a write of the job's state; writes are batched every 200 ms."""
+        self._dirty[job.job_id] = job
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_jobs())
+
+    async def _flush_jobs(self):
+        await asyncio.sleep(0.2)
+        batch, self._dirty = list(self._dirty.values()), {}
+        self._flush_task = None
+        now  = time.time()
+        rows = [(j.status, j.key, self._dump(j), now, j.job_id) for j in batch]
+        try:
+            await self._run(self._tx, lambda: self.db.executemany(
+                "UPDATE jobs SET status = ?, key = ?, data = ?, updated_at = ? WHERE job_id = ?", rows))
+        except Exception as e:
+            print(f"Job state flush failed: {e}")
+
+    async def get_job(self, job_id: str) -> Optional[Job]:
+        row = await self._run(lambda: self.db.execute(
+            "SELECT status, data FROM jobs WHERE job_id = ?", (job_id,)).fetchone())
+        return self._load(*row) if row else None
+
+    async def position(self, job: Job) -> int:
+        sql = (f"WITH o AS ({self.FAIR_ORDER}), me AS (SELECT turn, seq FROM o WHERE job_id = ?) "
+               "SELECT COUNT(*) FROM o, me WHERE o.turn < me.turn OR (o.turn = me.turn AND o.seq <= me.seq)")
+        (pos,) = await self._run(lambda: self.db.execute(sql, (job.job_id,)).fetchone())
+        return pos
+
+    async def queued(self) -> int:
+        (n,) = await self._run(lambda: self.db.execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued'").fetchone())
+        return n
+
+    async def expire(self, max_age: float):
+        now = time.time()
+
+        def purge():
+            self.db.execute("DELETE FROM jobs WHERE status IN ('done', 'error', 'toobig') AND updated_at < ?",
+                            (now - max_age,))
+            # Claimed by a process that died mid-job
+            self.db.execute("UPDATE jobs SET status = 'error' WHERE status = 'processing' AND updated_at < ?",
+                            (now - 2 * YTDLP_TIMEOUT,))
+            self.db.execute("DELETE FROM rate_limits WHERE ts < ?", (now - rate_limiter.ttl,))
+
+        await self._run(self._tx, purge)
+        for jid, job in list(job_store.items()):
+            if now - job.created_at > max_age:
+                job_store.pop(jid, None)
+
+    # --- rate limits ---
+    async def rate_limit(self, key: str) -> float:
+        """Same token bucket as RateLimiter, kept in the rate_limits table."""
+        rate, burst = rate_limiter.rate, rate_limiter.burst
+
+        def hit() -> float:
+            now = time.time()
+            row = self.db.execute("SELECT tokens, ts FROM rate_limits WHERE key = ?", (key,)).fetchone()
+            tokens = min(burst, row[0] + (now - row[1]) * rate) if row else burst
+            if tokens < 1:
+                return (1 - tokens) / rate
+            self.db.execute("INSERT OR REPLACE INTO rate_limits VALUES (?, ?, ?)", (key, tokens - 1, now))
+            return 0
+
+        return await self._run(self._tx, hit)
+
+    async def limiter_stats(self) -> Dict[str, int]:
+        (keys,) = await self._run(lambda: self.db.execute("SELECT COUNT(*) FROM rate_limits").fetchone())
+        return {"keys": keys}
+
+    # --- cache index ---
+    async def cache_get(self, key: str) -> Optional[str]:
+        row = await self._run(lambda: self.db.execute("SELECT path FROM cache_index WHERE key = ?", (key,)).fetchone())
+        if not row:
+            return None
+        if not await asyncio.to_thread(os.path.exists, row[0]):
+            await self.cache_drop(key)
+            return None
+        await self._run(lambda: self.db.execute(
+            "UPDATE cache_index SET last_access = ?, hits = hits + 1 WHERE key = ?", (int(time.time()), key)))
+        return row[0]
+
+    async def cache_put(self, key: str, path: str):
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            size = 0
+        await self._run(lambda: self.db.execute(
+            "INSERT OR REPLACE INTO cache_index (key, path, size, last_access, hits) VALUES (?, ?, ?, ?, 0)",
+            (key, path, size, int(time.time()))))
+        await self.cache_evict()
+
+    async def cache_drop(self, key: str, path: Optional[str] = None):
+        await self._run(lambda: self.db.execute(
+            "DELETE FROM cache_index WHERE key = ? AND (? IS NULL OR path = ?)", (key, path, path)))
+
+    async def cache_entries(self) -> Dict[str, str]:
+        rows = await self._run(lambda: self.db.execute("SELECT key, path FROM cache_index").fetchall())
+        return dict(rows)
+
+    async def cache_stats(self):
+        return await self._run(lambda: tuple(self.db.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM cache_index").fetchone()))
+
+    async def close(self):
+        if self._flush_task is not None:
+            await self._flush_task
+        self.db.close()
+
+    async def cache_evict(self):
+        """LRU eviction that spares files any process's jobs may still serve.
+
+        Keys of queued, processing and done jobs in the shared table are kept
+        (done jobs live until expire(), web users fetch their file meanwhile);
+        job_store covers local changes that are not flushed yet.
+        """
+        in_use = {j.filename for j in job_store.values() if j.filename}
+
+        def pick() -> List[str]:
+            (total,) = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM cache_index").fetchone()
+            victims = []
+            if total <= CACHE_MAX_BYTES:
+                return victims
+            for key, path, size in self.db.execute(
+                    "SELECT key, path, size FROM cache_index WHERE key NOT IN "
+                    "(SELECT key FROM jobs WHERE status IN ('queued', 'processing', 'done')) "
+                    "ORDER BY last_access").fetchall():
+                if total <= CACHE_MAX_BYTES:
+                    break
+                if path in in_use:
                     continue
-            except Exception:
-                pass  # probe failed — attempt download anyway
-
-            # Download
-            filepath = await asyncio.to_thread(ytdlp_download, job.url)
+                self.db.execute("DELETE FROM cache_index WHERE key = ?", (key,))
+                victims.append(path)
+                total -= size
+            return victims
 
-            real_size = None
+        for path in await self._run(self._tx, pick):
             try:
-                real_size = os.path.getsize(filepath)
-            except Exception:
+                os.remove(path)
+            except OSError:
                 pass
+            bump("cache_evictions")
+
+def make_backend(url: str):
+    if not url or url == "memory":
+        if ROLE == "api":
+            # Nothing else can see this process's queue, and it runs no workers
+            raise ValueError("ROLE=api needs a shared BACKEND_URL (sqlite:///...)")
+        return InMemoryBackend()
+    if url.startswith("sqlite:///"):
+        return SqliteBackend(url[len("sqlite:///"):], BACKEND_JOURNAL)
+    raise ValueError(f"Unsupported BACKEND_URL: {url}")
+
+backend = make_backend(BACKEND_URL)
+
+# ──────────────────────────────────────────────────────────────
+# TELEGRAM API HELPER
+# ──────────────────────────────────────────────────────────────
+http_client: Optional[httpx.AsyncClient] = None   # shared, keep-alive pooled
+
+def get_http() -> httpx.AsyncClient:
+    global http_client
+    if http_client is None:
+        http_client = httpx.AsyncClient(
+            timeout=30,
+            limits=httpx.Limits(max_connections=64, max_keepalive_connections=32),
+        )
+    return http_client
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate     = rate
+        self.capacity = capacity
+        self.tokens   = capacity
+        self.ts       = time.monotonic()
+
+    def reserve(self) -> float:
+        """Take a token if one is available (returns 0), else return the wait in seconds."""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.ts) * self.rate)
+        self.ts = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def full(self) -> bool:
+        return self.tokens + (time.monotonic() - self.ts) * self.rate >= self.capacity
+
+@dataclass
+class TgCall:
+    method:    str
+    chat_id:   int
+    payload:   Dict[str, Any]
+    file_path: Optional[str] = None     # uploaded as multipart field "video"
+    future:    Optional[asyncio.Future] = None
+    attempts:  int = 0
+    upload:    Optional[httpx.Timeout] = None   # video upload: its timeout; never resent once sent
+
+class TgDispatcher:
+    """Outbound Bot API queue with per-chat and global token buckets.
+
+    Calls to the same chat are sent in submission order. A chat whose bucket
+    is empty (or that got a 429 with retry_after) is rescheduled with
+    call_later, so it never holds a sender slot while waiting.
+    """
+
+    def __init__(self, senders: int, global_rate: float, chat_rate: float, chat_burst: int):
+        self.senders    = senders
+        self.chat_rate  = chat_rate
+        self.chat_burst = chat_burst
+        self._global  = TokenBucket(global_rate, global_rate)
+        self._chats:   Dict[int, Deque[TgCall]] = {}   # chat_id -> pending calls (present = scheduled)
+        self._buckets: Dict[int, TokenBucket]   = {}
+        self._ready:   asyncio.Queue = asyncio.Queue()
+        self._tasks:   List[asyncio.Task] = []
+
+    def start(self):
+        for _ in range(self.senders):
+            self._tasks.append(asyncio.create_task(self._sender()))
+
+    async def stop(self):
+        for t in self._tasks:
+            t.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
+
+    def pending(self) -> int:
+        return sum(len(q) for q in self._chats.values())
+
+    def prune(self):
+        """Drop idle per-chat buckets (a full bucket is the same as a fresh one)."""
+        for chat_id, bucket in list(self._buckets.items()):
+            if chat_id not in self._chats and bucket.full():
+                del self._buckets[chat_id]
+
+    def submit(self, call: TgCall) -> asyncio.Future:
+        call.future = asyncio.get_running_loop().create_future()
+        calls = self._chats.get(call.chat_id)
+        if calls is None:
+            self._chats[call.chat_id] = deque([call])
+            self._ready.put_nowait(call.chat_id)
+        else:
+            calls.append(call)
+        return call.future
+
+    def _later(self, delay: float, chat_id: int):
+        asyncio.get_running_loop().call_later(delay, self._ready.put_nowait, chat_id)
+
+    async def _sender(self):
+        while True:
+            chat_id = await self._ready.get()
+            calls   = self._chats[chat_id]
+            bucket  = self._buckets.get(chat_id)
+            if bucket is None:
+                bucket = self._buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+            delay = bucket.reserve()
+            if delay:
+                self._later(delay, chat_id)
+                continue
+            while (delay := self._global.reserve()):
+                await asyncio.sleep(delay)
 
-            if real_size and real_size > MAX_BYTES:
-                stats["blocked_big"] = stats.get("blocked_big", 0) + 1
-                save_json(STATS_FILE, stats)
-                safe_cleanup(os.path.splitext(filepath)[0])
-                job.status  = "toobig"
-                job.size_mb = real_size / 1024 / 1024
-                if job.source == "telegram" and job.chat_id:
-                    await tg_send(job.chat_id, f"🚫 Слишком большое ({job.size_mb:.1f} МБ). Лимит {MAX_MB} МБ.")
-                add_history(job.url, "toobig", job.size_mb, job.source)
+            retry_after = await self._send(calls[0])
+            if retry_after is not None:
+                self._later(retry_after, chat_id)      # call stays at the head
                 continue
+            calls.popleft()
+            if calls:
+                self._ready.put_nowait(chat_id)
+            else:
+                del self._chats[chat_id]
+
+    async def _send(self, call: TgCall) -> Optional[float]:
+        """Perform the call. Returns a retry delay, or None once the future is resolved.
+
+        Only failures where Telegram surely did not act are retried: the
+        connection was never made, a 429, or a 5xx (except for uploads). After
+        a read timeout the message may already be out, so the caller gets an
+        error instead of a duplicate.
+        """
+        call.attempts += 1
+        started = time.perf_counter()
+        try:
+            if call.file_path:
+                with open(call.file_path, "rb") as f:
+                    data = {k: str(v) for k, v in call.payload.items()}
+                    r = await get_http().post(f"{TG_API}/{call.method}", data=data, files={"video": f},
+                                              timeout=call.upload)
+            elif call.upload:
+                r = await get_http().post(f"{TG_API}/{call.method}", json=call.payload, timeout=call.upload)
+            else:
+                r = await get_http().post(f"{TG_API}/{call.method}", json=call.payload)
+            if r.status_code >= 500:
+                resp = {"ok": False, "error_code": r.status_code, "description": f"HTTP {r.status_code}"}
+            else:
+                resp = r.json()
+        except (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout) as e:
+            tg_api_seconds.observe(time.perf_counter() - started, call.method, "exception")
+            if call.attempts < TG_MAX_ATTEMPTS:
+                return min(2 ** call.attempts, 30)
+            resp = {"ok": False, "description": str(e)[:300] or type(e).__name__}
+        except Exception as e:
+            tg_api_seconds.observe(time.perf_counter() - started, call.method, "exception")
+            resp = {"ok": False, "description": str(e)[:300] or type(e).__name__}
+        else:
+            tg_api_seconds.observe(time.perf_counter() - started, call.method,
+                                   "ok" if resp.get("ok") else str(resp.get("error_code", "error")))
+
+        if call.attempts < TG_MAX_ATTEMPTS:
+            code = resp.get("error_code") or 0
+            if code == 429:
+                return float((resp.get("parameters") or {}).get("retry_after", 1))
+            if code >= 500 and not call.upload:
+                return min(2 ** call.attempts, 30)
+        if not call.future.done():
+            call.future.set_result(resp)
+        return None
+
+dispatcher = TgDispatcher(TG_SENDERS, TG_GLOBAL_RATE, TG_CHAT_RATE, TG_CHAT_BURST)
 
-            # Cache
-            url_cache[key] = filepath
-            save_json(CACHE_FILE, url_cache)
+async def tg_call(method: str, chat_id: int, payload: Dict[str, Any], file_path: Optional[str] = None,
+                  upload: Optional[httpx.Timeout] = None) -> Dict:
+    """Queue a Bot API call and wait for Telegram's response."""
+    if file_path and upload is None:
+        upload = upload_timeout(file_path)
+    return await dispatcher.submit(TgCall(method, chat_id, payload, file_path, upload=upload))
 
-            job.status   = "done"
-            job.filename  = filepath
-            job.size_mb   = (real_size or 0) / 1024 / 1024
+def upload_timeout(filepath: str) -> httpx.Timeout:
+    size_mb = os.path.getsize(filepath) / 1024 / 1024
+    return httpx.Timeout(min(TG_UPLOAD_TIMEOUT, 60 + size_mb), connect=30)
 
-            stats["downloads_ok"] = stats.get("downloads_ok", 0) + 1
-            save_json(STATS_FILE, stats)
-            add_history(job.url, "ok", job.size_mb, job.source)
+async def tg_send(chat_id: int, text: str):
+    """Fire-and-forget: the message is queued, the caller never waits on Telegram."""
+    if not BOT_TOKEN:
+        return
+    dispatcher.submit(TgCall("sendMessage", chat_id, {"chat_id": chat_id, "text": text}))
 
-            if job.source == "telegram" and job.chat_id:
-                await tg_send_video(job.chat_id, filepath)
-                if AD_TEXT:
-                    await tg_send(job.chat_id, AD_TEXT)
-                await tg_send(job.chat_id, "✅ Готово!")
+def _video_file_id(result: Dict) -> Optional[str]:
+    media = result.get("video") or result.get("animation") or result.get("document") or {}
+    return media.get("file_id")
 
+def local_file_uri(filepath: str) -> str:
+    path = os.path.realpath(filepath)
+    if TG_LOCAL_DIR:
+        path = os.path.join(TG_LOCAL_DIR, os.path.relpath(path, DOWNLOADS_DIR.resolve()))
+    return f"file://{path}"
+
+async def tg_send_video(chat_id: int, filepath: Optional[str], file_id: Optional[str] = None) -> Optional[str]:
+    """Send by cached file_id if given, upload the file otherwise. Return file_id."""
+    if not BOT_TOKEN:
+        return None
+    if file_id:
+        data = await tg_call("sendVideo", chat_id, {"chat_id": chat_id, "video": file_id})
+        if data.get("ok"):
+            return _video_file_id(data["result"]) or file_id
+        # Telegram rejected the id — fall back to uploading the bytes
+    if not filepath or not os.path.exists(filepath):
+        return None
+    if TG_LOCAL:
+        # Local Bot API server reads the file itself: no bytes go over HTTP
+        data = await tg_call("sendVideo", chat_id, {"chat_id": chat_id, "video": local_file_uri(filepath)},
+                             upload=upload_timeout(filepath))
+    else:
+        data = await tg_call("sendVideo", chat_id, {"chat_id": chat_id}, file_path=filepath)
+    if data.get("ok"):
+        return _video_file_id(data["result"])
+    return None
+
+# ──────────────────────────────────────────────────────────────
+# WORKER
+# ──────────────────────────────────────────────────────────────
+async def resolve(job: Job, key: str) -> str:
+    """Download (or find in cache) the video for job.url. Returns history status."""
+    # Cache hit
+    cached = await backend.cache_get(key)
+    if cached:
+        job.status   = "done"
+        job.filename = cached
+        return "cache"
+    # Telegram already has the video and only Telegram chats wait for it: send by file_id
+    telegram_only = lambda: all(j.source == "telegram" and j.chat_id for j in in_flight.get(key, [job]))
+    if telegram_only() and await file_id_get(key) and telegram_only():     # no web follower joined meanwhile
+        job.status = "done"
+        return "cache"
+
+    # Only now is an extraction needed — the breaker decides (and may take the half-open trial)
+    if not breaker.allow(extractor_domain(job.url)):
+        raise BreakerOpen(BREAKER_ERROR_MSG)
+
+    for j in in_flight.get(key, [job]):
+        j.status = "processing"
+        notify_job(j)
+        if j.source == "telegram" and j.chat_id:
+            await tg_send(j.chat_id, "⏳ Начинаю обработку...")
+
+    # Probe size (single extraction: the info dict is reused for the download)
+    info = probe_cache_get(key)
+    if info is None:
+        try:
+            with job_span(job, "probe"):
+                info = await run_ytdlp(ytdlp_probe, job.url)
+            probe_cache_put(key, info)
+        except Exception:
+            info = None  # probe failed — attempt download anyway
+    # Pick the best format that fits; too big only when none does
+    fmt = None
+    if info is not None:
+        fmt, size = pick_format(info, MAX_BYTES)
+        if fmt is None:
+            job.status  = "toobig"
+            job.size_mb = (size or 0) / 1024 / 1024
+            return "toobig"
+
+    # Download — aborted as soon as it grows past MAX_BYTES
+    def on_progress(done: int, total: Optional[int]):
+        for j in in_flight.get(key, [job]):
+            j.downloaded_bytes = done
+            j.total_bytes      = total or 0
+            notify_job(j)
+
+    try:
+        with job_span(job, "download"):
+            filepath = await run_ytdlp(ytdlp_download, job.url, str(DOWNLOADS_DIR), info, MAX_BYTES, fmt,
+                                       progress=on_progress)
+    except FileTooBig as e:
+        job.status  = "toobig"
+        job.size_mb = e.size / 1024 / 1024
+        return "toobig"
+
+    real_size = None
+    try:
+        real_size = os.path.getsize(filepath)
+    except Exception:
+        pass
+
+    if real_size and real_size > MAX_BYTES:
+        safe_cleanup(os.path.splitext(filepath)[0])
+        job.status  = "toobig"
+        job.size_mb = real_size / 1024 / 1024
+        return "toobig"
+
+    # Cache
+    await backend.cache_put(key, filepath)
+
+    job.status   = "done"
+    job.filename = filepath
+    job.size_mb  = (real_size or 0) / 1024 / 1024
+    return "ok"
+
+async def deliver(job: Job, outcome: str):
+    """Account for a finished job and notify its Telegram chat."""
+    if outcome == "cache":
+        bump("served_from_cache")
+    elif outcome == "ok":
+        bump("downloads_ok")
+    elif outcome == "toobig":
+        bump("blocked_big")
+    else:
+        bump("errors")
+    add_history(job.url, outcome, job.size_mb if outcome != "error" else 0, job.source, extractor_domain(job.url))
+
+    if job.source != "telegram" or not job.chat_id:
+        return
+    if job.status == "done":
+        key    = job.key or url_key(job.url)
+        cached = await file_id_get(key)
+        with job_span(job, "upload"):
+            file_id = await tg_send_video(job.chat_id, job.filename, cached)
+        if file_id and file_id != cached:
+            remember_file_id(key, file_id)
+        if not file_id and not job.filename:
+            # Served by file_id alone and Telegram rejected it: there is no file to upload
+            forget_file_id(key)
+            await tg_send(job.chat_id, "❌ Ошибка при скачивании. Попробуй ещё раз.")
+            return
+        if AD_TEXT:
+            await tg_send(job.chat_id, AD_TEXT)
+        await tg_send(job.chat_id, "✅ Готово (из кэша)!" if outcome == "cache" else "✅ Готово!")
+    elif job.status == "toobig":
+        await tg_send(job.chat_id, f"🚫 Слишком большое видео (~{job.size_mb:.1f} МБ). Лимит {MAX_MB} МБ.")
+    elif job.error_msg == BREAKER_ERROR_MSG:
+        await tg_send(job.chat_id, f"⏳ {BREAKER_ERROR_MSG}")
+    else:
+        await tg_send(job.chat_id, "❌ Ошибка при скачивании. Попробуй другую ссылку.")
+
+async def settle_key(job: Job) -> Optional[str]:
+    """Resolve a short link's key here rather than on the update path, and move its flight.
+
+    Returns the key to process under, or None when the resolved URL already
+    has a flight (queued or downloading) and this one was attached to it.
+    """
+    key = job.key or url_key(job.url)
+    if not _is_short_link(job.url):
+        return key
+    with job_span(job, "resolve"):
+        real = await resolve_key(job.url)
+    if real == key:
+        return key
+    flight = in_flight.pop(key, None) or [job]
+    for j in flight:
+        j.key = real
+        backend.job_changed(j)
+    target = in_flight.get(real)
+    if target:
+        target.extend(flight)        # its leader delivers to all of them
+        return None
+    in_flight[real] = flight
+    return real
+
+async def process_job(job: Job):
+    started = time.time()
+    observe_stage(job, "queue", started - job.created_at)
+    key = await settle_key(job)
+    if key is None:
+        return
+    domain = extractor_domain(job.url)
+    hit = negative_get(key)
+    if hit:
+        job.status, job.size_mb, job.error_msg = hit
+        outcome = "toobig" if job.status == "toobig" else "error"
+        bump("negative_hits")
+    else:
+        refused = False
+        try:
+            outcome = await resolve(job, key)
+        except BreakerOpen:
+            job.status, job.error_msg = "error", BREAKER_ERROR_MSG
+            outcome, refused = "error", True
+            bump("breaker_rejected")
         except Exception as e:
-            stats["errors"] = stats.get("errors", 0) + 1
-            save_json(STATS_FILE, stats)
             job.status    = "error"
             job.error_msg = str(e)[:300]
-            add_history(job.url, "error", 0, job.source)
-            if job.source == "telegram" and job.chat_id:
-                try:
-                    await tg_send(job.chat_id, "❌ Ошибка при скачивании. Попробуй другую ссылку.")
-                except Exception:
-                    pass
+            outcome = "error"
+        recent_durations.append(time.time() - started)
+        if not refused and outcome != "cache":       # only extractions say anything about the site
+            permanent = outcome == "error" and is_permanent_error(job.error_msg)
+            breaker.record(domain, outcome != "error" or permanent)
+            if outcome == "toobig" or permanent:
+                negative_put(key, job.status, job.size_mb, job.error_msg)
+
+    # Everyone attached to this flight finishes from the leader's result
+    flight = in_flight.pop(key, None) or [job]
+    for j in flight:
+        if j is not job:
+            j.status, j.filename, j.size_mb, j.error_msg = job.status, job.filename, job.size_mb, job.error_msg
+            if outcome == "ok":
+                bump("coalesced")
+        notify_job(j)
+        try:
+            await deliver(j, "cache" if j is not job and outcome == "ok" else outcome)
+        except Exception as e:
+            bump("delivery_errors")
+            print(f"Delivery of job {j.job_id} ({j.source}) failed: {e}")
+        finally:
+            await backend.finish(j)
+            record_job(j, outcome if j is job or outcome != "ok" else "cache")
+    queue.task_done()
+
+def record_job(job: Job, outcome: str):
+    total = time.time() - job.created_at
+    job_seconds.observe(total, metric_domain(job.url), job.source, outcome)
+    if SLOW_JOB_SECONDS and total >= SLOW_JOB_SECONDS:
+        spans = " ".join(f"{k}={v:.1f}s" for k, v in job.spans.items())
+        print(f"Slow job {job.job_id} ({job.source}, {extractor_domain(job.url)}, {outcome}): {total:.1f}s — {spans}")
+
+async def worker():
+    global busy_workers
+    while True:
+        # The backend only hands out jobs whose domain has a free slot; take it
+        # before yielding to the loop so no other worker can overshoot the cap
+        job: Job = await backend.dequeue()
+        domain = job.domain or extractor_domain(job.url)
+        domain_in_flight[domain] = domain_in_flight.get(domain, 0) + 1
+        busy_workers += 1
+        notify_queued()
+        try:
+            await process_job(job)
         finally:
-            await finish(job.user_key)
-            queue.task_done()
+            busy_workers -= 1
+            domain_in_flight[domain] -= 1
+            if domain_in_flight[domain] <= 0:
+                domain_in_flight.pop(domain, None)
+            queue.wake()
 
 # ──────────────────────────────────────────────────────────────
 # FASTAPI APP
@@ -333,31 +2036,105 @@ app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_methods=["*"], all
 
 @app.on_event("startup")
 async def startup():
-    asyncio.create_task(worker())
+    get_http()
+    dispatcher.start()
+    asyncio.create_task(frontend.load())     # compress index.html before the first page view
+    if ROLE in ("all", "worker"):       # only workers run yt-dlp
+        if ytdlp_pool is not None:
+            ytdlp_pool.start()
+        else:
+            # Import yt-dlp and build YoutubeDL instances in the background: webhooks are
+            # accepted right away, a job arriving earlier just waits for the import
+            async def _warm_ytdlp():
+                try:
+                    await asyncio.get_running_loop().run_in_executor(ytdlp_threads, ydl_pool.warm, str(DOWNLOADS_DIR))
+                    print(f"yt-dlp warm: {ydl_pool.stats()}")
+                except Exception as e:
+                    print(f"yt-dlp warm-up failed: {e}")
+            asyncio.create_task(_warm_ytdlp())
+
+    # Re-key cache entries written before keys were canonical
+    for k in [k for k in url_cache if url_key(k) != k]:
+        path = url_cache[k]
+        cache_drop(k)
+        cache_put(url_key(k), path)
+    for k, file_id in [(k, f) for k, f in store.rows("SELECT key, file_id FROM file_ids") if url_key(k) != k]:
+        forget_file_id(k)
+        remember_file_id(url_key(k), file_id)
+    # Other nodes may be mid-download into a shared downloads/
+    await reconcile_cache(min_age=ORPHAN_GRACE_SECONDS if backend.shared else 0)
+
+    if ROLE in ("all", "worker"):
+        for _ in range(WORKER_COUNT):
+            asyncio.create_task(worker())
+    asyncio.create_task(update_processor())
     # Auto-cleanup old jobs and files every hour
     async def _cleanup():
         while True:
             await asyncio.sleep(3600)
-            now = time.time()
-            for jid, job in list(job_store.items()):
-                if now - job.created_at > 7200:
-                    job_store.pop(jid, None)
+            try:
+                await backend.expire(7200)
+            except Exception as e:
+                print(f"Job expiry failed: {e}")
+            dispatcher.prune()
+            probe_cache_expire()
+            prune_history()
+            try:
+                await reconcile_cache(min_age=ORPHAN_GRACE_SECONDS)
+            except Exception as e:
+                print(f"Cache reconcile failed: {e}")
     asyncio.create_task(_cleanup())
 
+    # Periodic flush of buffered state writes
+    async def _flusher():
+        while True:
+            await asyncio.sleep(STATE_FLUSH_SECONDS)
+            try:
+                await store.flush()
+                await refresh_user_count()
+            except Exception as e:
+                print(f"State flush failed: {e}")
+    asyncio.create_task(_flusher())
+
     # Register webhook if configured
     if BOT_TOKEN and WEBHOOK_URL:
-        async with httpx.AsyncClient() as client:
-            wh_url = WEBHOOK_URL.rstrip("/") + "/webhook"
-            payload = {"url": wh_url}
-            if WEBHOOK_SECRET:
-                payload["secret_token"] = WEBHOOK_SECRET
-            r = await client.post(f"{TG_API}/setWebhook", json=payload)
-            print(f"Webhook set: {r.json()}")
-    print("Worker started. App ready.")
+        wh_url = WEBHOOK_URL.rstrip("/") + "/webhook"
+        payload = {"url": wh_url}
+        if WEBHOOK_SECRET:
+            payload["secret_token"] = WEBHOOK_SECRET
+        r = await get_http().post(f"{TG_API}/setWebhook", json=payload)
+        print(f"Webhook set: {r.json()}")
+    print(f"Workers started ({WORKER_COUNT}). App ready.")
+
+@app.on_event("shutdown")
+async def shutdown():
+    if ytdlp_pool is not None:
+        await ytdlp_pool.close()
+    if ytdlp_threads is not None:
+        ytdlp_threads.shutdown(wait=False, cancel_futures=True)
+    await dispatcher.stop()
+    if http_client is not None:
+        await http_client.aclose()
+    await backend.close()
+    await store.flush()
+    store.close()
 
 # ──────────────────────────────────────────────────────────────
 # TELEGRAM WEBHOOK ENDPOINT
 # ──────────────────────────────────────────────────────────────
+# Updates are acknowledged immediately and handled by update_processor();
+# recent update_ids are remembered so Telegram redeliveries are ignored.
+recent_update_ids: "OrderedDict[int, None]" = OrderedDict()
+update_queue: asyncio.Queue = asyncio.Queue(maxsize=UPDATE_QUEUE_LIMIT)
+
+def seen_update(update_id: int) -> bool:
+    if update_id in recent_update_ids:
+        return True
+    recent_update_ids[update_id] = None
+    if len(recent_update_ids) > UPDATE_DEDUP_SIZE:
+        recent_update_ids.popitem(last=False)
+    return False
+
 @app.post("/webhook")
 async def webhook(request: Request, x_telegram_bot_api_secret_token: Optional[str] = Header(None)):
     # Verify secret if configured
@@ -366,10 +2143,28 @@ async def webhook(request: Request, x_telegram_bot_api_secret_token: Optional[st
             raise HTTPException(status_code=403, detail="Invalid secret")
 
     update = await request.json()
+    update_id = update.get("update_id")
+    if isinstance(update_id, int) and seen_update(update_id):
+        return {"ok": True}
+    try:
+        update_queue.put_nowait(update)
+    except asyncio.QueueFull:
+        recent_update_ids.pop(update_id, None)
+        raise HTTPException(status_code=503, detail="Busy")   # Telegram will redeliver
+    return {"ok": True}
+
+async def update_processor():
+    while True:
+        update = await update_queue.get()
+        try:
+            await handle_update(update)
+        except Exception as e:
+            print(f"Update {update.get('update_id')} failed: {e}")
 
+async def handle_update(update: Dict[str, Any]):
     msg = update.get("message") or update.get("edited_message")
     if not msg:
-        return {"ok": True}
+        return
 
     user    = msg.get("from", {})
     user_id = user.get("id", 0)
@@ -377,13 +2172,12 @@ async def webhook(request: Request, x_telegram_bot_api_secret_token: Optional[st
     text    = msg.get("text", "")
 
     # Track users
-    if user_id and user_id not in users:
-        users.add(user_id)
-        save_users()
+    if user_id:
+        save_user(user_id)
 
     # Ban check
     if user_id in banned_ids:
-        return {"ok": True}
+        return
 
     # Commands
     if text.startswith("/start"):
@@ -393,7 +2187,7 @@ async def webhook(request: Request, x_telegram_bot_api_secret_token: Optional[st
             "🤖 Pinterest, Instagram, TikTok, YouTube и другие.\n"
             "🌐 Также доступна веб-версия!"
         )
-        return {"ok": True}
+        return
 
     if text.startswith("/stats") and user_id in ADMIN_IDS:
         total = stats.get("total_requests", 0)
@@ -401,61 +2195,62 @@ async def webhook(request: Request, x_telegram_bot_api_secret_token: Optional[st
         succ  = 100 - (err * 100 // total) if total else 100
         await tg_send(chat_id,
             f"📊 Статистика\n"
-            f"👥 Пользователи: {len(users)}\n"
+            f"👥 Пользователи: {user_count}\n"
             f"📥 Запросов: {total}\n"
             f"✅ Скачано: {stats.get('downloads_ok', 0)}\n"
             f"⚡ Из кэша: {stats.get('served_from_cache', 0)}\n"
             f"🚫 Большие: {stats.get('blocked_big', 0)}\n"
             f"❌ Ошибки: {err}\n"
             f"🔥 Успешность: {succ}%\n"
-            f"🧠 Очередь: {queue.qsize()}\n"
+            f"🧠 Очередь: {await backend.queued()}\n"
+            f"⚙️ Воркеры: {busy_workers}/{WORKER_COUNT}\n"
             f"🔨 Забанено: {len(banned_ids)}"
         )
-        return {"ok": True}
+        return
 
     if text.startswith("/ban ") and user_id in ADMIN_IDS:
         parts = text.split()
         if len(parts) == 2 and parts[1].lstrip("-").isdigit():
             target = int(parts[1])
-            banned_ids.add(target)
-            save_json(BANS_FILE, sorted(list(banned_ids)))
+            set_banned(target, True)
             await tg_send(chat_id, f"✅ Забанен: {target}")
-        return {"ok": True}
+        return
 
     if text.startswith("/unban ") and user_id in ADMIN_IDS:
         parts = text.split()
         if len(parts) == 2 and parts[1].lstrip("-").isdigit():
             target = int(parts[1])
-            banned_ids.discard(target)
-            save_json(BANS_FILE, sorted(list(banned_ids)))
+            set_banned(target, False)
             await tg_send(chat_id, f"✅ Разбанен: {target}")
-        return {"ok": True}
+        return
 
     # URL handling
     url = extract_url(text)
     if not url:
         await tg_send(chat_id, "Кинь ссылку одним сообщением 🙂")
-        return {"ok": True}
+        return
 
-    now  = time.time()
-    last = last_request_time.get(str(user_id), 0)
-    if now - last < COOLDOWN_SECONDS:
-        wait = int(COOLDOWN_SECONDS - (now - last))
-        await tg_send(chat_id, f"⏳ Подожди {wait}с")
-        return {"ok": True}
-    last_request_time[str(user_id)] = now
+    wait = await backend.rate_limit(str(user_id))
+    if wait:
+        await tg_send(chat_id, f"⏳ Подожди {math.ceil(wait)}с")
+        return
 
-    stats["total_requests"] = stats.get("total_requests", 0) + 1
-    save_json(STATS_FILE, stats)
+    bump("total_requests")
 
     job = Job(job_id=uuid.uuid4().hex, user_key=str(user_id), url=url, source="telegram", chat_id=chat_id)
-    ok  = await enqueue(job)
+    ok  = await backend.enqueue(job)
     if not ok:
         await tg_send(chat_id, "🚫 Очередь перегружена или у тебя уже много запросов. Подожди 🙂")
-        return {"ok": True}
+        return
+    if job.status in FINAL_STATUSES:       # answered from the negative cache / breaker
+        await deliver(job, job.status)
+        return
 
-    await tg_send(chat_id, f"✅ В очереди (позиция ~{queue.qsize()})")
-    return {"ok": True}
+    pos = await backend.position(job)
+    if pos:
+        await tg_send(chat_id, f"✅ В очереди (позиция {pos}, ожидание ~{queue_eta(pos)} с)")
+    else:
+        await tg_send(chat_id, "✅ Принято, обрабатываю")
 
 # ──────────────────────────────────────────────────────────────
 # WEB API
@@ -466,6 +2261,17 @@ class DownloadReq(BaseModel):
 class AdminReq(BaseModel):
     password: str
 
+class HistoryReq(BaseModel):
+    password: str
+    cursor:   Optional[int] = None    # next_cursor of the previous page
+    limit:    int = 100
+    status:   Optional[str] = None
+    source:   Optional[str] = None
+    domain:   Optional[str] = None
+    since:    Optional[int] = None    # unix ts, inclusive
+    until:    Optional[int] = None    # unix ts, exclusive
+    counts:   bool = False            # add aggregate counts for the filters
+
 class BanReq(BaseModel):
     password: str
     target: int   # user_id or pseudo-id
@@ -482,41 +2288,73 @@ async def api_download(req: DownloadReq, request: Request):
     if not url:
         raise HTTPException(status_code=400, detail="Не найдена ссылка")
 
-    now  = time.time()
-    last = last_request_time.get(f"web_{ip}", 0)
-    if now - last < COOLDOWN_SECONDS:
-        wait = int(COOLDOWN_SECONDS - (now - last))
-        raise HTTPException(status_code=429, detail=f"Подожди {wait} секунд")
-    last_request_time[f"web_{ip}"] = now
+    wait = await backend.rate_limit(f"web_{ip}")
+    if wait:
+        raise HTTPException(status_code=429, detail=f"Подожди {math.ceil(wait)} секунд")
 
-    stats["total_requests"] = stats.get("total_requests", 0) + 1
-    save_json(STATS_FILE, stats)
+    bump("total_requests")
 
     job = Job(job_id=uuid.uuid4().hex, user_key=f"web_{ip}", url=url, source="web")
-    ok  = await enqueue(job)
+    ok  = await backend.enqueue(job)
     if not ok:
         raise HTTPException(status_code=429, detail="Очередь перегружена или слишком много запросов")
+    if job.status in FINAL_STATUSES:       # answered from the negative cache / breaker
+        await deliver(job, job.status)
 
-    return {"job_id": job.job_id, "queue_pos": queue.qsize()}
+    pos = await backend.position(job)
+    return {"job_id": job.job_id, "queue_pos": pos, "eta_s": queue_eta(pos)}
 
 @app.get("/api/status/{job_id}")
 async def api_status(job_id: str):
-    job = job_store.get(job_id)
+    job = await backend.get_job(job_id)
     if not job:
         raise HTTPException(status_code=404, detail="Задача не найдена")
-    resp: Dict[str, Any] = {
-        "status":    job.status,
-        "error_msg": job.error_msg,
-        "size_mb":   round(job.size_mb, 1),
-        "ad_text":   AD_TEXT if job.status == "done" else "",
-    }
-    if job.status == "done":
-        resp["download_url"] = f"/api/file/{job_id}"
-    return resp
+    return await job_snapshot(job)
+
+@app.get("/api/events/{job_id}")
+async def api_events(job_id: str):
+    """Server-Sent Events: pushes the job snapshot on every change until it finishes."""
+    job = await backend.get_job(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Задача не найдена")
+    # A shared backend's jobs change in other processes: poll it instead of waiting for a wake-up
+    wait_s = 1.0 if backend.shared else SSE_KEEPALIVE_SECONDS
+
+    async def stream():
+        nonlocal job
+        wake: asyncio.Queue = asyncio.Queue(maxsize=1)
+        job_watchers.setdefault(job_id, set()).add(wake)
+        try:
+            yield f"retry: {SSE_RETRY_MS}\n\n"
+            last, sent_at = None, time.monotonic()
+            while True:
+                snap = await job_snapshot(job)
+                if snap != last:
+                    yield f"data: {json.dumps(snap, ensure_ascii=False)}\n\n"
+                    last, sent_at = snap, time.monotonic()
+                if job.status in FINAL_STATUSES:
+                    return
+                try:
+                    await asyncio.wait_for(wake.get(), wait_s)
+                except asyncio.TimeoutError:
+                    if time.monotonic() - sent_at >= SSE_KEEPALIVE_SECONDS:
+                        yield ": ping\n\n"
+                        sent_at = time.monotonic()
+                if backend.shared:
+                    job = await backend.get_job(job_id) or job
+        finally:
+            watchers = job_watchers.get(job_id)
+            if watchers is not None:
+                watchers.discard(wake)
+                if not watchers:
+                    job_watchers.pop(job_id, None)
+
+    return StreamingResponse(stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 @app.get("/api/file/{job_id}")
 async def api_file(job_id: str):
-    job = job_store.get(job_id)
+    job = await backend.get_job(job_id)
     if not job or job.status != "done" or not job.filename:
         raise HTTPException(status_code=404, detail="Файл не найден")
     if not os.path.exists(job.filename):
@@ -529,31 +2367,76 @@ async def api_file(job_id: str):
 @app.post("/api/admin/stats")
 async def admin_stats(req: AdminReq):
     check_admin(req.password)
+    cache_entries, cache_size = await backend.cache_stats()
     return {
         **stats,
-        "queue_size":   queue.qsize(),
+        "backend":      "shared" if backend.shared else "memory",
+        "role":         ROLE,
+        "queue_size":   await backend.queued(),
         "banned_count": len(banned_ids),
-        "user_count":   len(users),
+        "user_count":   user_count,
+        "recent_users": len(recent_users),
+        "rate_limiter": await backend.limiter_stats(),
         "active_jobs":  len(job_store),
+        "tg_outbox":    dispatcher.pending(),
+        "ytdlp_executor":  YTDLP_EXECUTOR,
+        "tg_local":        TG_LOCAL,
+        "max_mb":          MAX_MB,
+        "ytdlp_processes": ytdlp_pool.stats() if ytdlp_pool else None,
+        "ytdlp_instances": ydl_pool.stats() if ytdlp_pool is None else None,   # per process in process mode
+        "cache_entries":   cache_entries,
+        "cache_mb":        round(cache_size / 1024 / 1024, 1),
+        "cache_budget_mb": CACHE_MAX_BYTES // 1024 // 1024,
+        "updates_pending": update_queue.qsize(),
+        "workers":      WORKER_COUNT,
+        "workers_busy": busy_workers,
+        "worker_utilisation": round(busy_workers / WORKER_COUNT, 2),
+        "domains_in_flight":  dict(domain_in_flight),
+        "domains_waiting":    queue.blocked(),
+        "negative_cache":     len(negative_cache),
+        "circuit_breakers":   breaker.snapshot(),
+    }
+
+@app.get("/metrics")
+async def metrics(authorization: Optional[str] = Header(None)):
+    """Prometheus scrape endpoint: stage latency histograms, counters and gauges."""
+    if METRICS_TOKEN and not hmac.compare_digest(authorization or "", f"Bearer {METRICS_TOKEN}"):
+        raise HTTPException(status_code=403, detail="Forbidden")
+    lines: List[str] = []
+    for name, value in sorted(stats.items()):
+        lines += [f"# TYPE saveit_{name}_total counter", f"saveit_{name}_total {value}"]
+    gauges = {
+        "queue_size":      await backend.queued(),
+        "workers":         WORKER_COUNT,
+        "workers_busy":    busy_workers,
+        "tg_outbox":       dispatcher.pending(),
+        "updates_pending": update_queue.qsize(),
     }
+    for name, value in gauges.items():
+        lines += [f"# TYPE saveit_{name} gauge", f"saveit_{name} {value}"]
+    for hist in (stage_seconds, job_seconds, tg_api_seconds):
+        lines += hist.render()
+    return Response("\n".join(lines) + "\n", media_type="text/plain; version=0.0.4")
 
 @app.post("/api/admin/history")
-async def admin_history(req: AdminReq):
+async def admin_history(req: HistoryReq):
     check_admin(req.password)
-    return {"history": history[:100]}
+    limit   = max(1, min(req.limit, 500))
+    filters = {"status": req.status, "source": req.source, "domain": req.domain,
+               "since": req.since, "until": req.until}
+    await store.flush()
+    return await asyncio.to_thread(query_history, filters, req.cursor, limit, req.counts)
 
 @app.post("/api/admin/ban")
 async def admin_ban(req: BanReq):
     check_admin(req.password)
-    banned_ids.add(req.target)
-    save_json(BANS_FILE, sorted(list(banned_ids)))
+    set_banned(req.target, True)
     return {"ok": True}
 
 @app.post("/api/admin/unban")
 async def admin_unban(req: BanReq):
     check_admin(req.password)
-    banned_ids.discard(req.target)
-    save_json(BANS_FILE, sorted(list(banned_ids)))
+    set_banned(req.target, False)
     return {"ok": True}
 
 @app.get("/api/admin/banned")
@@ -561,13 +2444,87 @@ async def admin_list_banned(password: str):
     check_admin(password)
     return {"banned": sorted(list(banned_ids))}
 
-# Serve frontend
+# --- Frontend ---
+class Frontend:
+    """index.html held in memory with gzip/brotli variants; reloaded when its mtime changes.
+
+    The max-level compression takes a while for a large page, so it runs in a
+    thread, once per change (startup loads it before the first request).
+    """
+
+    CHECK_SECONDS = 1.0       # how often the mtime is looked at
+
+    def __init__(self, path: Path):
+        self.path     = path
+        self.mtime    = None
+        self.checked  = 0.0
+        self.etag     = ""
+        self.variants: Dict[str, bytes] = {}     # content-encoding -> body
+        self._lock    = asyncio.Lock()
+
+    def _build(self) -> Tuple[Dict[str, bytes], str]:
+        raw = self.path.read_bytes()
+        variants = {"identity": raw, "gzip": gzip.compress(raw, 9)}
+        if brotli is not None:
+            variants["br"] = brotli.compress(raw, quality=11)
+        return variants, hashlib.sha256(raw).hexdigest()[:20]
+
+    async def load(self) -> bool:
+        """Refresh from disk if changed; False if the file is missing."""
+        now = time.monotonic()
+        if self.variants and now - self.checked < self.CHECK_SECONDS:
+            return True
+        self.checked = now
+        try:
+            mtime = self.path.stat().st_mtime_ns
+        except OSError:
+            self.variants = {}
+            return False
+        if mtime != self.mtime:
+            async with self._lock:
+                if mtime != self.mtime:          # not rebuilt while we waited
+                    try:
+                        self.variants, self.etag = await asyncio.to_thread(self._build)
+                    except OSError:
+                        self.variants = {}
+                        return False
+                    self.mtime = mtime
+        return bool(self.variants)
+
+    def pick(self, accept_encoding: str) -> str:
+        accepted = {}
+        for part in accept_encoding.lower().split(","):
+            name, _, params = part.strip().partition(";")
+            q = 1.0
+            if params.strip().startswith("q="):
+                try:
+                    q = float(params.strip()[2:])
+                except ValueError:
+                    q = 0.0
+            accepted[name.strip()] = q
+        for encoding in ("br", "gzip"):
+            if encoding in self.variants and accepted.get(encoding, accepted.get("*", 0)) > 0:
+                return encoding
+        return "identity"
+
+frontend = Frontend(Path("index.html"))
+
 @app.get("/{full_path:path}")
-async def serve_frontend(full_path: str):
-    html_path = Path("index.html")
-    if html_path.exists():
-        return HTMLResponse(html_path.read_text(encoding="utf-8"))
-    return HTMLResponse("<h1>index.html not found</h1>", status_code=404)
+async def serve_frontend(full_path: str, request: Request):
+    if full_path == "api" or full_path.startswith("api/"):
+        raise HTTPException(status_code=404, detail="Not found")
+    if not await frontend.load():
+        return HTMLResponse("<h1>index.html not found</h1>", status_code=404)
+
+    encoding = frontend.pick(request.headers.get("accept-encoding", ""))
+    etag     = f'"{frontend.etag}-{encoding}"'
+    headers  = {"ETag": etag, "Cache-Control": "no-cache", "Vary": "Accept-Encoding"}
+    client_tags = {t.strip().removeprefix("W/") for t in request.headers.get("if-none-match", "").split(",")}
+    if etag in client_tags or "*" in client_tags:
+        return Response(status_code=304, headers=headers)
+    if encoding != "identity":
+        headers["Content-Encoding"] = encoding
+    return Response(frontend.variants[encoding], media_type="text/html; charset=utf-8", headers=headers)
 
 if __name__ == "__main__":
     import uvicorn